@@ -95,6 +95,151 @@ function applySetting(sd, name, payload) {
     return false;
 }
 
+// Sample schemas announced by producers logging with `intern_schema`: their
+// samples arrive as 'packed_samples' rows of [time, values], `values` holding
+// the little-endian field values back to back in schema order. Schema ids are
+// derived from the layout, so one map serves all sessions.
+const sampleSchemas = new Map();
+// Rows that arrived before their schema (the setup channel is separate from
+// the timeseries one), replayed once it is known.
+const pendingPackedSamples = new Map();
+const MAX_PENDING_PACKED = 1000;
+
+const SCHEMA_DTYPES = {
+    'f8': [8, (dv, o, le) => dv.getFloat64(o, le)],
+    'f4': [4, (dv, o, le) => dv.getFloat32(o, le)],
+    'i8': [8, (dv, o, le) => Number(dv.getBigInt64(o, le))],
+    'i4': [4, (dv, o, le) => dv.getInt32(o, le)],
+    'i2': [2, (dv, o, le) => dv.getInt16(o, le)],
+    'i1': [1, (dv, o) => dv.getInt8(o)],
+    'u8': [8, (dv, o, le) => Number(dv.getBigUint64(o, le))],
+    'u4': [4, (dv, o, le) => dv.getUint32(o, le)],
+    'u2': [2, (dv, o, le) => dv.getUint16(o, le)],
+    'u1': [1, (dv, o) => dv.getUint8(o)],
+    'b1': [1, (dv, o) => dv.getUint8(o)],
+};
+
+function registerSchema(payload) {
+    const unknown = payload.fields.find(([, dtype]) => !SCHEMA_DTYPES[dtype.slice(1)]);
+    if (unknown) {
+        console.warn('Unsupported dtype in sample schema:', unknown[1]);
+        return;
+    }
+    const fields = payload.fields.map(([name, dtype, dim]) => {
+        const [size, read] = SCHEMA_DTYPES[dtype.slice(1)];
+        return {name, size, read, dim, le: dtype[0] !== '>'};
+    });
+    // Values are packed scalars first, then vectors, each in schema order.
+    let offset = 0;
+    for (const f of fields.filter(f => f.dim === 0)) {
+        f.offset = offset;
+        offset += f.size;
+    }
+    for (const f of fields.filter(f => f.dim !== 0)) {
+        f.offset = offset;
+        offset += f.size * f.dim;
+    }
+    sampleSchemas.set(payload.id, fields);
+
+    const pending = pendingPackedSamples.get(payload.id);
+    if (pending) {
+        pendingPackedSamples.delete(payload.id);
+        pending.forEach(parsewebSocketData);
+    }
+}
+
+function unpackSampleValues(fields, bytes) {
+    const dv = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    const payload = {};
+    for (const f of fields) {
+        if (f.dim === 0) {
+            payload[f.name] = f.read(dv, f.offset, f.le);
+        } else {
+            const value = new Array(f.dim);
+            for (let i = 0, offset = f.offset; i < f.dim; i++, offset += f.size) {
+                value[i] = f.read(dv, offset, f.le);
+            }
+            payload[f.name] = value;
+        }
+    }
+    return payload;
+}
+
+// Sample blocks ('sample_block' items, see python/mim_data_utils/sample_blocks.py)
+// hold the samples of a session column-wise as float64 bytes. Columns are
+// copied into typed arrays once instead of being decoded value by value.
+// 'raw' columns are row-major little-endian float64; 'delta' and 'xor' columns
+// are column-major float64 bit patterns, zigzag deltas or XORed with the
+// previous value, and times the zigzag delta-of-delta of their bits.
+function float64Column(bytes) {
+    // slice() copies into a fresh, aligned buffer.
+    return new Float64Array(bytes.slice().buffer);
+}
+
+function unzigzag(v) {
+    return (v >> 1n) ^ -(v & 1n);
+}
+
+function decodeBlockTime(block) {
+    if ((block.encoding || 'raw') === 'raw') {
+        return float64Column(block.time);
+    }
+    const dod = new BigUint64Array(block.time.slice().buffer);
+    const bits = new BigInt64Array(block.n);
+    let delta = 0n, prev = 0n;
+    for (let i = 0; i < block.n; i++) {
+        delta = BigInt.asIntN(64, delta + unzigzag(dod[i]));
+        bits[i] = prev = BigInt.asIntN(64, prev + delta);
+    }
+    return new Float64Array(bits.buffer);
+}
+
+// The row-major [n, dim] values of a block field (dim 0 for scalars).
+function decodeBlockColumn(block, bytes, dim) {
+    const encoding = block.encoding || 'raw';
+    if (encoding === 'raw') {
+        return float64Column(bytes);
+    }
+    const n = block.n, width = Math.max(dim, 1);
+    const words = new BigUint64Array(bytes.slice().buffer);
+    const bits = new BigInt64Array(n * width);
+    for (let k = 0; k < width; k++) {
+        let prev = 0n;
+        for (let i = 0; i < n; i++) {
+            const w = words[k * n + i];
+            prev = encoding === 'delta'
+                ? BigInt.asIntN(64, prev + unzigzag(w))
+                : BigInt.asIntN(64, prev ^ w);
+            bits[i * width + k] = prev;
+        }
+    }
+    return new Float64Array(bits.buffer);
+}
+
+function parseSampleBlock(sd, block) {
+    const times = decodeBlockTime(block);
+    const fields = block.fields
+        .filter(([name]) => name !== 'time')
+        .map(([name, dim, bytes]) => {
+            return [name, Math.max(dim, 1), decodeBlockColumn(block, bytes, dim)];
+        });
+
+    // Same as parseTimeSample, stopping at the first sample a frozen session
+    // has no space left for.
+    const frozen = sd === currentSession ? isFrozen : sd.frozen;
+    for (let i = 0; i < block.n; i++) {
+        if (frozen && sd.traces.willEvictFirstData(wsMaxData)) {
+            break;
+        }
+        sd.traces.beginTimestep(times[i], wsMaxData);
+        for (const [name, width, values] of fields) {
+            sd.traces.record(name, values.subarray(i * width, (i + 1) * width));
+        }
+    }
+    sd.traces.endTimestep();
+    return false;
+}
+
 // Registered setups: the 3d scene objects and viewer settings the server keeps
 // per session and replays whenever a viewer connects, so a page reload does not
 // lose the meshes and point clouds that were registered before it opened.
@@ -111,7 +256,10 @@ function parseSetup(sd, data) {
         }
         return true;
     } else if (data.op === 'set') {
-        if (data.kind === 'scene') {
+        if (data.kind === 'schema') {
+            registerSchema(data.payload);
+            return false;
+        } else if (data.kind === 'scene') {
             // Goes through traces so the existing Traces::recordStaticData
             // handler in scene3d.js builds the Mesh3D / PointCloud3D (only
             // when this session is the displayed one; see SessionData).
@@ -160,6 +308,40 @@ function parsewebSocketData(data) {
             relayout = parseTimeSample(sd, data)
         }
 
+        if (!sd.hasData) {
+            sd.hasData = true;
+            if (active) {
+                firstNewData();
+            }
+        }
+    } else if (data.type == 'packed_samples') {
+        const fields = sampleSchemas.get(data.schema);
+        if (!fields) {
+            let pending = pendingPackedSamples.get(data.schema);
+            if (!pending) {
+                pendingPackedSamples.set(data.schema, pending = []);
+            }
+            if (pending.length < MAX_PENDING_PACKED) {
+                pending.push(data);
+            }
+            return;
+        }
+
+        for (const [time, values] of data.rows) {
+            relayout = parseTimeSample(sd, {
+                time: time, payload: unpackSampleValues(fields, values)
+            }) || relayout;
+        }
+
+        if (!sd.hasData) {
+            sd.hasData = true;
+            if (active) {
+                firstNewData();
+            }
+        }
+    } else if (data.type == 'sample_block') {
+        relayout = parseSampleBlock(sd, data);
+
         if (!sd.hasData) {
             sd.hasData = true;
             if (active) {
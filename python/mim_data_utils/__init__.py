@@ -13,6 +13,10 @@ from .logger import (
 
 from .recorder import Recorder
 
+from .sampling import SamplingPolicy, EveryNth, Decimate, MinMax
+
+from .data_utils import DataReader
+
 from .scene import RawMesh, Mesh, Scene
 try:
     from .mujoco import MujocoVisualizer
@@ -0,0 +1,250 @@
+"""
+Columnar extraction of the 'sample' entries of a recording.
+
+Turns the stream of `{'type': 'sample', 'time': t, 'payload': {...}}` entries
+into one float64 time vector and one `[N, dim]` array per payload field,
+filled into preallocated buffers that grow geometrically. The list of entry
+dicts is never materialized. `ColumnCache` keeps the result next to the
+recording so later opens can memory-map it instead of decoding again.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .sample_blocks import decode_block
+
+_INITIAL_CAPACITY = 1024
+
+
+class ColumnBuilder:
+    """Accumulates samples into growable per-field numpy buffers.
+
+    Only numeric payload values (numbers, bools, lists / arrays of numbers)
+    become columns; strings and scene objects are skipped. A field missing in
+    a sample, or added after the first samples, is NaN for those rows. If
+    `fields` is given, only those fields are kept.
+    """
+
+    def __init__(self, fields=None, dtype=np.float64):
+        self.fields = set(fields) if fields is not None else None
+        self.dtype = dtype
+        self.n = 0
+        self.capacity = _INITIAL_CAPACITY
+        self.time = np.empty(self.capacity, np.float64)
+        self.columns = {}
+
+    def _grow(self, needed=None):
+        needed = needed or self.capacity + 1
+        while self.capacity < needed:
+            self.capacity *= 2
+        self.time.resize(self.capacity, refcheck=False)
+        for key, col in self.columns.items():
+            grown = np.full((self.capacity, col.shape[1]), np.nan, col.dtype)
+            grown[:self.n] = col[:self.n]
+            self.columns[key] = grown
+
+    def _column(self, key, dim):
+        col = self.columns.get(key)
+        if col is None:
+            col = np.full((self.capacity, dim), np.nan, self.dtype)
+            self.columns[key] = col
+        elif col.shape[1] != dim:
+            raise ValueError(
+                f"Field '{key}' changed its size from {col.shape[1]} to {dim}.")
+        return col
+
+    def add(self, t, payload):
+        """Append one sample at time `t`."""
+        if self.n == self.capacity:
+            self._grow()
+
+        row = self.n
+        self.time[row] = t
+
+        for key, value in payload.items():
+            if key == 'time':
+                continue
+            if self.fields is not None and key not in self.fields:
+                continue
+
+            if isinstance(value, (float, int)):
+                self._column(key, 1)[row, 0] = value
+            elif isinstance(value, (list, np.ndarray)):
+                if len(value) == 0 or not np.isscalar(value[0]) or \
+                        isinstance(value[0], (str, bytes)):
+                    continue
+                self._column(key, len(value))[row] = value
+
+        self.n += 1
+
+    def add_block(self, block):
+        """Append all samples of a 'sample_block', column by column."""
+        time, columns = decode_block(block)
+        n = len(time)
+        if self.n + n > self.capacity:
+            self._grow(self.n + n)
+
+        rows = slice(self.n, self.n + n)
+        self.time[rows] = time
+        for key, values in columns.items():
+            if key == 'time':
+                continue
+            if self.fields is not None and key not in self.fields:
+                continue
+            if values.ndim == 1:
+                values = values[:, None]
+            self._column(key, values.shape[1])[rows] = values
+
+        self.n += n
+
+    def add_entry(self, entry, session=None):
+        """Append a recorded entry if it is a timed sample or a sample block
+        (of `session`)."""
+        kind = entry.get('type')
+        if kind not in ('sample', 'sample_block'):
+            return
+        if session is not None and entry.get('session') != session:
+            return
+        if kind == 'sample_block':
+            self.add_block(entry)
+            return
+
+        t = entry.get('time')
+        if not isinstance(t, (float, int)) or isinstance(t, bool):
+            return  # E.g. 'static' samples.
+
+        self.add(t, entry['payload'])
+
+    def finish(self):
+        """The columns as `{'time': float64[N], field: [N, dim]}`."""
+        n = self.n
+        self.time.resize(n, refcheck=False)
+        res = {'time': self.time}
+        for key, col in self.columns.items():
+            col.resize((n, col.shape[1]), refcheck=False)
+            res[key] = col
+        return res
+
+
+# Bytes hashed from the head and tail of a recording for its cache signature.
+_SIGNATURE_BYTES = 64 * 1024
+
+
+def file_signature(path):
+    """Cheap identity of a recording: its size, mtime and a hash over its
+    first and last 64 KB (so a cache check doesn't read the whole file)."""
+    st = os.stat(path)
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fh:
+        h.update(fh.read(_SIGNATURE_BYTES))
+        if st.st_size > _SIGNATURE_BYTES:
+            fh.seek(max(_SIGNATURE_BYTES, st.st_size - _SIGNATURE_BYTES))
+            h.update(fh.read())
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': h.hexdigest()}
+
+
+class ColumnCache:
+    """Sidecar directory of `.npy` files holding the columns of a recording.
+
+    Every query (session, dtype) gets its own subdirectory with one `.npy`
+    file per field plus `meta.json`, which records the source signature and
+    is written last, so an interrupted write is never picked up. Cached
+    columns are returned as read-only `np.memmap` views: reopening is near
+    instant and the pages are shared between processes.
+    """
+
+    def __init__(self, recording_path, cache_dir=None):
+        self.recording_path = str(recording_path)
+        self.cache_dir = Path(cache_dir or self.recording_path + '.columns')
+
+    def _entry_dir(self, session, dtype):
+        key = json.dumps({'session': session, 'dtype': np.dtype(dtype).str})
+        return self.cache_dir / hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def load(self, session=None, dtype=np.float64, fields=None):
+        """The cached columns, None if missing or stale."""
+        entry_dir = self._entry_dir(session, dtype)
+        try:
+            with open(entry_dir / 'meta.json') as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+        if meta.get('source') != file_signature(self.recording_path):
+            return None
+
+        res = {}
+        for name, filename in meta['files'].items():
+            if name != 'time' and fields is not None and name not in fields:
+                continue
+            res[name] = np.load(entry_dir / filename, mmap_mode='r')
+        return res
+
+    def save(self, columns, session=None, dtype=np.float64):
+        """Write `columns` (a full `to_columns` result) to the cache.
+
+        Files of an earlier version may still be mapped (here or by other
+        processes), so they are never rewritten: every version gets files
+        named after its source signature, and the old ones are unlinked once
+        `meta.json` points at the new ones.
+        """
+        entry_dir = self._entry_dir(session, dtype)
+        entry_dir.mkdir(parents=True, exist_ok=True)
+        source = file_signature(self.recording_path)
+        version = hashlib.sha1(
+            json.dumps(source).encode()).hexdigest()[:12]
+
+        files = {}
+        for i, (name, col) in enumerate(columns.items()):
+            filename = f'{version}_{i:05d}.npy'
+            tmp = entry_dir / f'{filename}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as fh:
+                np.save(fh, col)
+            os.replace(tmp, entry_dir / filename)
+            files[name] = filename
+
+        meta = {
+            'source': source,
+            'session': session,
+            'files': files,
+        }
+        tmp = entry_dir / f'meta.json.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(meta, fh)
+        os.replace(tmp, entry_dir / 'meta.json')
+
+        # Unlinking keeps the data of live maps of the old files.
+        for path in entry_dir.glob('*.npy'):
+            if path.name not in files.values():
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+
+def concat_columns(parts, dtype=np.float64):
+    """Concatenate `to_columns` results in order, NaN-filling fields that are
+    missing from some of the parts."""
+    dims = {}
+    for part in parts:
+        for key, col in part.items():
+            if key == 'time':
+                continue
+            if dims.setdefault(key, col.shape[1]) != col.shape[1]:
+                raise ValueError(
+                    f"Field '{key}' changed its size from {dims[key]} to "
+                    f"{col.shape[1]}.")
+
+    res = {'time': np.concatenate(
+        [part['time'] for part in parts] or [np.empty(0, np.float64)])}
+    for key, dim in dims.items():
+        res[key] = np.concatenate([
+            part[key] if key in part else
+            np.full((len(part['time']), dim), np.nan, dtype)
+            for part in parts
+        ])
+    return res
@@ -0,0 +1,276 @@
+"""
+Recompress recordings for archiving.
+
+Live recordings are written at a low zstd level, unindexed in the case of
+older files, and the websocket `Recorder` stores every 'sessions' control
+message and every setup replay the server sends on (re)connect. This rewrites
+a recording at a high level with multi-threaded zstd (optionally with a
+trained dictionary), as an indexed recording with larger batches, samples as
+delta encoded sample blocks and without the redundant messages, then reads
+both files back to check that every other entry survived unchanged.
+
+    python -m mim_data_utils.compact recording.zst --in-place
+"""
+
+import hashlib
+import math
+import os
+
+import ormsgpack
+
+from .logger import FileLoggerWriter, FileLoggerReader
+from .recording import blob_path
+from .schema import is_schema_setup
+
+# Entries handed to the writer per record (see `FileLoggerWriter.log_entries`).
+_CHUNK_ITEMS = 4000
+
+# Batches of the output used to train its dictionary, with `dictionary`.
+_DICT_TRAIN_BATCHES = 200
+
+
+def compact_path(path):
+    """Default output path of `compact_recording`."""
+    root, ext = os.path.splitext(str(path))
+    return f'{root}.compact{ext or ".zst"}'
+
+
+class _Redundancy:
+    """Tells the entries that repeat state the recording already holds.
+
+    Setups are tracked like the server's `SetupRegistry` does: a 'set' equal
+    to the registered item (a replay to a reconnecting viewer, a producer
+    re-registering), or a 'remove' of nothing, changes nothing. A 'clear' or
+    'launch' drops the session's setups. 'sessions'
+    messages only matter when the set of live sessions changes. Schema setups
+    are dropped as well: readers expand packed samples, which are written out
+    as plain samples or sample blocks.
+    """
+
+    def __init__(self):
+        self.setups = {}  # session -> {(kind, key): item}
+        self.sessions = None
+        self.dropped = {}
+
+    def _is_redundant(self, entry):
+        kind = entry.get('type')
+        if kind == 'sessions':
+            names = sorted(str(s.get('name')) for s in entry.get('sessions') or ()
+                           if isinstance(s, dict))
+            if names == self.sessions:
+                return True
+            self.sessions = names
+            return False
+
+        if kind != 'setup':
+            return False
+        if is_schema_setup(entry):
+            return True
+
+        op = entry.get('op')
+        session = entry.get('session')
+        if op in ('clear', 'launch'):
+            # A launch starts the session fresh: the server and viewers drop
+            # its setups, so the producer's next registrations are new.
+            self.setups.pop(session, None)
+            return False
+
+        store = self.setups.setdefault(session, {})
+        key = (entry.get('kind'), entry.get('key'))
+        if op == 'remove':
+            return store.pop(key, None) is None
+        if op == 'set':
+            if store.get(key) == entry:
+                return True
+            store[key] = entry
+        return False
+
+    def keep(self, entry):
+        if not self._is_redundant(entry):
+            return True
+        kind = entry.get('type')
+        self.dropped[kind] = self.dropped.get(kind, 0) + 1
+        return False
+
+
+def _normalized(value):
+    """`value` with ints as floats where that is exact (sample blocks store
+    float64) and NaNs made comparable, for fingerprinting. An int a float
+    can't hold stays an int, so losing its precision fails the check."""
+    if isinstance(value, dict):
+        return {key: _normalized(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalized(v) for v in value]
+    if isinstance(value, int) and not isinstance(value, bool):
+        as_float = float(value)
+        return as_float if as_float == value else value
+    if isinstance(value, float) and math.isnan(value):
+        return 'NaN'
+    return value
+
+
+def _fingerprint(entries):
+    """Count and digest of the entries per stream, i.e. per type and session
+    (and field layout, for samples). Within a stream the order is kept by
+    the rewrite; across streams it isn't, as samples are grouped in blocks."""
+    res = {}
+    for entry in entries:
+        kind = entry.get('type')
+        stream = (kind, entry.get('session'))
+        if kind == 'sample' and isinstance(entry.get('payload'), dict):
+            stream += tuple(entry['payload'])
+        count, digest = res.get(stream) or (0, hashlib.blake2b())
+        digest.update(ormsgpack.packb(_normalized(entry)))
+        res[stream] = (count + 1, digest)
+    return {stream: (count, digest.hexdigest())
+            for stream, (count, digest) in res.items()}
+
+
+def _entries(path, keep=None):
+    reader = FileLoggerReader(path, to_numpy=False)
+    try:
+        for batch in reader.iter_batches():
+            for entry in batch:
+                if keep is None or keep(entry):
+                    yield entry
+    finally:
+        reader.close()
+
+
+def verify_compacted(path, output, drop_redundant=True):
+    """Whether `output` holds the entries `compact_recording` keeps of the
+    recording at `path`."""
+    keep = _Redundancy().keep if drop_redundant else None
+    return _fingerprint(_entries(output)) == _fingerprint(_entries(path, keep))
+
+
+def compact_recording(path, output=None, compression_level=19, threads=None,
+                      dictionary=False, sample_encoding='delta',
+                      drop_redundant=True, verify=True, **writer_kwargs):
+    """Rewrite the recording at `path` to `output` (default:
+    '<name>.compact.zst') for archiving, see the module docstring.
+
+    The output is compressed at `compression_level` with `threads` zstd
+    worker threads (all cores if None), with a dictionary trained on its
+    first batches if `dictionary`, and samples stored as `sample_encoding`
+    blocks (plain samples if None). `drop_redundant` drops the setup replays
+    and repeated 'sessions' messages. If the input keeps its binary data in a
+    blob file, so does the output. `writer_kwargs` are passed on to the
+    `FileLoggerWriter` of the output.
+
+    With `verify` both files are read back and compared stream by stream
+    (see `_fingerprint`); a mismatch raises a ValueError.
+
+    Returns a summary dict (entries and bytes in and out, dropped entries).
+    """
+    output = output or compact_path(path)
+    if os.path.abspath(output) == os.path.abspath(path):
+        raise ValueError('Compacting a recording onto itself, '
+                         'write to another path first.')
+
+    writer_kwargs.setdefault('max_file_size_mb', None)
+    writer_kwargs.setdefault('blob_store', os.path.exists(blob_path(path)))
+    writer = FileLoggerWriter(
+        output, compression_level=compression_level,
+        compression_threads=threads if threads is not None else os.cpu_count(),
+        train_dict_batches=_DICT_TRAIN_BATCHES if dictionary else 0,
+        sample_encoding=sample_encoding, **writer_kwargs)
+
+    redundancy = _Redundancy()
+    entries_in = 0
+
+    def kept():
+        nonlocal entries_in
+        for entry in _entries(path):
+            entries_in += 1
+            if not drop_redundant or redundancy.keep(entry):
+                yield entry
+
+    try:
+        entries_out = writer.log_entries(kept(), _CHUNK_ITEMS)
+    finally:
+        writer.close()
+
+    if verify and not verify_compacted(path, output, drop_redundant):
+        raise ValueError(f'{output} does not round-trip the entries of {path}.')
+
+    def size(p):
+        return os.path.getsize(p) + (
+            os.path.getsize(blob_path(p)) if os.path.exists(blob_path(p)) else 0)
+
+    return {
+        'output': output,
+        'entries_in': entries_in,
+        'entries_out': entries_out,
+        'dropped': redundancy.dropped,
+        'bytes_in': size(path),
+        'bytes_out': size(output),
+        'verified': verify,
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Recompress .zst recordings for archiving: high zstd '
+                    'level on all cores, index, redundant messages dropped.')
+    parser.add_argument('paths', nargs='+', help='Recordings to compact')
+    parser.add_argument('-o', '--output', default=None,
+                        help="Output path (one input only, default: "
+                             "'<name>.compact.zst')")
+    parser.add_argument('--in-place', action='store_true',
+                        help='Replace the inputs once their output is verified')
+    parser.add_argument('--level', type=int, default=19,
+                        help='Zstandard compression level 1-22 (default: 19)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='zstd worker threads (default: all cores)')
+    parser.add_argument('--dictionary', action='store_true',
+                        help='Compress with a dictionary trained on the data')
+    parser.add_argument('--sample-encoding', default='delta',
+                        choices=['delta', 'xor', 'raw', 'none'],
+                        help="Sample block encoding, 'none' for plain samples "
+                             "(default: delta)")
+    parser.add_argument('--keep-redundant', action='store_true',
+                        help="Keep setup replays and repeated 'sessions' messages")
+    parser.add_argument('--no-verify', action='store_true',
+                        help='Skip reading back and comparing the output')
+    args = parser.parse_args()
+
+    if args.output and len(args.paths) > 1:
+        parser.error('--output needs a single input')
+    if args.output and args.in_place:
+        parser.error('--output and --in-place exclude each other')
+
+    for path in args.paths:
+        try:
+            res = compact_recording(
+                path, args.output, compression_level=args.level,
+                threads=args.threads, dictionary=args.dictionary,
+                sample_encoding=None if args.sample_encoding == 'none'
+                else args.sample_encoding,
+                drop_redundant=not args.keep_redundant,
+                verify=not args.no_verify)
+        except (OSError, ValueError) as e:
+            print(f'[compact] {path}: {e}')
+            continue
+
+        output = res['output']
+        if args.in_place:
+            os.replace(output, path)
+            if os.path.exists(blob_path(output)):
+                os.replace(blob_path(output), blob_path(path))
+            elif os.path.exists(blob_path(path)):
+                os.remove(blob_path(path))
+            output = path
+
+        dropped = ', '.join(f'{n} {kind}' for kind, n in res['dropped'].items())
+        print(f"[compact] {path}: {res['bytes_in'] / 1e6:.1f} MB -> "
+              f"{res['bytes_out'] / 1e6:.1f} MB ({output}), "
+              f"{res['entries_out']} of {res['entries_in']} entries kept"
+              + (f' (dropped {dropped})' if dropped else '')
+              + (', verified' if res['verified'] else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Convert legacy DataLogger files into recordings.
+
+Streams a gzip compressed DataLogger file (see `data_utils`) into an indexed
+.zst recording holding its records as delta encoded sample blocks, so old
+logs can be read with `FileLoggerReader` and its time queries like any other
+recording. Only a chunk of records is held in memory at a time.
+
+    python -m mim_data_utils.convert_legacy run.mds --dt 0.002
+"""
+
+import gzip
+import os
+
+import numpy as np
+
+from .data_utils import is_gzip, data_type, data_size, read_header
+from .logger import FileLoggerWriter
+from .sample_blocks import make_block
+
+# Records per sample block.
+_CHUNK_RECORDS = 2000
+
+
+def legacy_output_path(path):
+    """Default output path of `convert_legacy`."""
+    return os.path.splitext(str(path))[0] + '.zst'
+
+
+def convert_legacy(path, output=None, dt=0.001, t0=0., session=None,
+                   time_field='time', sample_encoding='delta', **writer_kwargs):
+    """Convert the legacy file at `path` into a recording at `output`
+    (default: the path with a .zst extension) and return the number of
+    samples written.
+
+    Each record becomes a sample of `session` (default: the file name
+    without extension) with one field per legacy field, scalars for fields
+    of size 1. Its time is the value of the `time_field` field if the file
+    has one (which is then not stored as a field), else `t0 + i * dt` for
+    record i. `writer_kwargs` are passed on to the `FileLoggerWriter`.
+    """
+    output = output or legacy_output_path(path)
+    session = session or os.path.splitext(os.path.basename(str(path)))[0]
+    writer_kwargs.setdefault('max_file_size_mb', None)
+
+    opener = gzip.open if is_gzip(path) else open
+    with opener(path, 'rb') as fh:
+        _, fields = read_header(fh)
+        record_floats = sum(size for _, size in fields)
+        record_bytes = record_floats * data_size
+
+        slices = []
+        start = 0
+        for name, size in fields:
+            slices.append((name, size, slice(start, start + size)))
+            start += size
+        time_column = next(
+            (columns for name, size, columns in slices
+             if name == time_field and size == 1), None)
+
+        writer = FileLoggerWriter(output, sample_encoding=None, **writer_kwargs)
+        count = 0
+        try:
+            while record_bytes:
+                data = fh.read(record_bytes * _CHUNK_RECORDS)
+                n = len(data) // record_bytes  # Drops a truncated last record.
+                if not n:
+                    break
+                records = np.frombuffer(
+                    data, data_type, n * record_floats).reshape(n, record_floats)
+
+                if time_column is not None:
+                    time = records[:, time_column.start].astype(np.float64)
+                else:
+                    time = t0 + np.arange(count, count + n) * dt
+                columns = {
+                    name: records[:, columns] if size > 1
+                    else records[:, columns.start]
+                    for name, size, columns in slices
+                    if columns is not time_column
+                }
+                writer.log([make_block(session, time, columns, sample_encoding)])
+                count += n
+        finally:
+            writer.close()
+
+    return count
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Convert legacy DataLogger files into .zst recordings.')
+    parser.add_argument('paths', nargs='+', help='Legacy files to convert')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Output path (one input only, default: the input '
+                             'path with a .zst extension)')
+    parser.add_argument('--dt', type=float, default=0.001,
+                        help="Time step between records in seconds, for files "
+                             "without a 'time' field (default: 0.001)")
+    parser.add_argument('--t0', type=float, default=0.,
+                        help='Time of the first record (default: 0)')
+    parser.add_argument('--session', default=None,
+                        help='Session of the samples (default: the file name)')
+    parser.add_argument('--compression-level', type=int, default=10,
+                        help='Zstandard compression level 1-22 (default: 10)')
+    args = parser.parse_args()
+
+    if args.output and len(args.paths) > 1:
+        parser.error('--output needs a single input')
+
+    for path in args.paths:
+        output = args.output or legacy_output_path(path)
+        try:
+            count = convert_legacy(
+                path, output, dt=args.dt, t0=args.t0, session=args.session,
+                compression_level=args.compression_level)
+        except (OSError, EOFError) as e:
+            print(f'[convert] {path}: {e}')
+            continue
+        print(f'[convert] Wrote {count} samples of {path} to {output}')
+
+
+if __name__ == '__main__':
+    main()
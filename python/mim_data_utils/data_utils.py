@@ -0,0 +1,164 @@
+"""
+Reader for the legacy DataLogger format.
+
+Files written by the C++ `DataLogger` (src/data_logger.cpp) and the former
+Python one are gzip compressed and hold
+
+    uint32 idx, uint32 num_fields
+    num_fields x (char name[64], uint32 size)
+    float32 records of sum(size) values, one per timestep
+
+Every record has the same size, so the data section is read as one
+`(N, record_floats)` float32 matrix: the file is inflated once (or mapped
+from an uncompressed sidecar, see `DataReader`) and every field is a view of
+its columns, without copying.
+"""
+
+import gzip
+import os
+import struct
+
+import numpy as np
+
+data_type = np.float32
+data_size = 4
+
+_HEADER = struct.Struct('II')
+_FIELD = struct.Struct('64s I')
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+def read_header(fh):
+    """`(idx, fields)` of a legacy file, `fields` as [(name, size), ...]."""
+    idx, num_fields = _HEADER.unpack(fh.read(_HEADER.size))
+    fields = []
+    for _ in range(num_fields):
+        name, size = _FIELD.unpack(fh.read(_FIELD.size))
+        fields.append((name.decode('utf8').rstrip('\x00'), size))
+    return idx, fields
+
+
+def data_offset(num_fields):
+    """Byte offset of the first record."""
+    return _HEADER.size + _FIELD.size * num_fields
+
+
+def raw_path(filepath):
+    """Path of the uncompressed sidecar of a legacy file."""
+    return str(filepath) + '.raw'
+
+
+def is_gzip(filepath):
+    """Whether a legacy file is gzip compressed (the logger always does)."""
+    with open(filepath, 'rb') as fh:
+        return fh.read(2) == _GZIP_MAGIC
+
+
+def _inflate_to(filepath, path):
+    tmp = path + '.tmp'
+    with gzip.open(filepath, 'rb') as src, open(tmp, 'wb') as dst:
+        while True:
+            chunk = src.read(16 * 1024 * 1024)
+            if not chunk:
+                break
+            dst.write(chunk)
+    os.replace(tmp, path)
+
+
+class DataReader:
+    """Reads a legacy DataLogger file.
+
+    `fields` lists `(name, size)` and, once read, `data` maps every field name
+    to a float32 `[N, size]` array: a view of the record matrix `records`.
+    `read_chunck(i)` returns the values of timestep `i` without reading the
+    others.
+
+    Gzip compressed files are inflated into memory on first access. With
+    `cache` they are inflated into an uncompressed sidecar ('<file>.raw')
+    instead, once, and memory mapped from then on, so reopening a file costs
+    next to nothing. Uncompressed files are always memory mapped. A truncated
+    last record is ignored.
+    """
+
+    def __init__(self, filepath, read_data=True, suppress_output=True,
+                 cache=False):
+        self.filepath = str(filepath)
+        self.suppress_output = suppress_output
+        self.cache = cache
+
+        self.fields = []
+        self.data = {}
+        self._records = None
+
+        with self._open() as fh:
+            self.read_header(fh)
+
+        if read_data:
+            self.read_data()
+
+    def _open(self):
+        if is_gzip(self.filepath):
+            return gzip.open(self.filepath, 'rb')
+        return open(self.filepath, 'rb')
+
+    def read_header(self, fh):
+        self.idx, self.fields = read_header(fh)
+        self.num_fields = len(self.fields)
+        self.record_floats = sum(size for _, size in self.fields)
+        self.chunck_size = self.record_floats * data_size
+
+        if not self.suppress_output:
+            print('idx:', self.idx, 'fields:', self.num_fields)
+            print(self.fields)
+
+    def _source(self):
+        """The uncompressed file as a buffer (bytes or memory map)."""
+        if not is_gzip(self.filepath):
+            return np.memmap(self.filepath, np.uint8, 'r')
+
+        if not self.cache:
+            with open(self.filepath, 'rb') as fh:
+                return gzip.decompress(fh.read())
+
+        path = raw_path(self.filepath)
+        if not os.path.exists(path) or \
+                os.path.getmtime(path) < os.path.getmtime(self.filepath):
+            _inflate_to(self.filepath, path)
+        return np.memmap(path, np.uint8, 'r')
+
+    @property
+    def records(self):
+        """All records as a float32 `[N, record_floats]` matrix."""
+        if self._records is None:
+            source = self._source()
+            offset = data_offset(self.num_fields)
+            n = (len(source) - offset) // self.chunck_size \
+                if self.chunck_size else 0
+            self._records = np.frombuffer(
+                source, data_type, n * self.record_floats, offset
+            ).reshape(n, self.record_floats)
+        return self._records
+
+    def __len__(self):
+        return len(self.records)
+
+    def _slices(self):
+        start = 0
+        for name, size in self.fields:
+            yield name, slice(start, start + size)
+            start += size
+
+    def read_chunck(self, chunck_idx, data=None):
+        """Reads a single chunck (timestep) of data and returns it."""
+        data = {} if data is None else data
+        row = self.records[chunck_idx]
+        for name, columns in self._slices():
+            data[name] = row[columns]
+        return data
+
+    def read_data(self):
+        """Reads all the data and stores it in self.data."""
+        records = self.records
+        for name, columns in self._slices():
+            self.data[name] = records[:, columns]
+        return self.data
@@ -0,0 +1,102 @@
+"""
+Summarize recordings without reading them.
+
+Prints the time span, sessions, item counts and bytes per type and camera,
+sample fields and markers of .zst recordings (see `FileLoggerReader.stats`).
+For recordings with an index this only reads the end of the file; with
+`--json` it prints one JSON object per recording, for batch jobs.
+
+    python -m mim_data_utils.inspect_recording recording_*.zst
+"""
+
+import datetime
+import json
+
+from .logger import FileLoggerReader
+
+
+def _size(n):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if n < 1000:
+            return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1000
+    return f'{n:.1f} TB'
+
+
+def _field(name, dim):
+    if dim is None:
+        return f'{name} (non-numeric)'
+    return f'{name}[{dim}]' if dim else name
+
+
+def format_stats(stats):
+    """The summary of `FileLoggerReader.stats` as printable text."""
+    lines = []
+    size = _size(stats['bytes'])
+    if stats['blob_bytes']:
+        size += f" + {_size(stats['blob_bytes'])} blobs"
+    layout = f"indexed, {stats['frames']} frames" if stats['indexed'] \
+        else 'not indexed'
+    lines.append(f"{stats['path']}: {size}, {layout}, "
+                 f"{stats['items']} items in {stats['records']} records")
+
+    if stats['t_min'] is not None:
+        duration = datetime.timedelta(seconds=stats['t_max'] - stats['t_min'])
+        lines.append(f"  time: {stats['t_min']:.3f} .. {stats['t_max']:.3f} "
+                     f"({duration})")
+    lines.append(f"  sessions: {', '.join(stats['sessions']) or '-'}")
+
+    lines.append(f"  {'type':<16} {'items':>10} {'bytes':>10}")
+    for kind, entry in sorted(stats['types'].items(),
+                              key=lambda kv: -kv[1]['bytes']):
+        lines.append(f"  {str(kind):<16} {entry['items']:>10} "
+                     f"{_size(entry['bytes']):>10}")
+    for name, entry in sorted(stats['cameras'].items(), key=lambda kv: str(kv[0])):
+        lines.append(f"  camera {str(name):<9} {entry['items']:>10} "
+                     f"{_size(entry['bytes']):>10}")
+
+    for session, fields in stats['fields'].items():
+        names = ', '.join(_field(name, dim) for name, dim in fields.items())
+        lines.append(f'  fields ({session}): {names}')
+
+    if stats['markers']:
+        lines.append(f"  markers ({len(stats['markers'])}):")
+        for t, label in stats['markers']:
+            t = f'{t:.3f}' if t is not None else '-'
+            lines.append(f'    {t} {label}')
+    return '\n'.join(lines)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Summarize .zst recordings (time span, sessions, types, '
+                    'fields, markers).')
+    parser.add_argument('paths', nargs='+', help='Recordings to summarize')
+    parser.add_argument('--json', action='store_true',
+                        help='Print one JSON object per recording')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        try:
+            reader = FileLoggerReader(path, to_numpy=False)
+        except OSError as e:
+            print(f'[inspect] Could not open {path}: {e}')
+            continue
+        try:
+            stats = reader.stats()
+        finally:
+            reader.close()
+
+        if args.json:
+            stats['types'] = {str(k): v for k, v in stats['types'].items()}
+            stats['cameras'] = {str(k): v for k, v in stats['cameras'].items()}
+            stats['fields'] = {str(k): v for k, v in stats['fields'].items()}
+            print(json.dumps(stats))
+        else:
+            print(format_stats(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,14 +7,28 @@ import threading
 
 
 
-import zstandard
-import struct
 import ormsgpack
 
 import queue
+from collections import deque
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor
 import multiprocessing
 
 from .scene import RawMesh, Scene, PointCloud
+from .columns import ColumnBuilder, ColumnCache, concat_columns
+from .sample_blocks import (
+    BlockBuilder, encode_samples, expand_block, item_layout, make_block,
+    sample_layout
+)
+from .sampling import SamplingPolicy
+from .schema import SampleSchema, SchemaInterner, is_schema_setup
+from .recording import (
+    RecordingWriter, read_index, read_header, decompressor, read_frame_bytes,
+    iter_records, read_record, item_time, frame_matches, entry_matches,
+    segment_path, numbered_segments, FrameStreamReader, BlobWriter,
+    BlobReader, blob_path, summarize, FrameStats, RecordingStats, HEAVY_TYPES
+)
 from kyber_utils.zeromq import ZmqPublisher, ZmqRemoteValue
 
 # Item types routed to the low-priority '/camera/' publisher (video frames).
@@ -29,20 +43,154 @@ _POINTCLOUD_TYPES = ('depth',)
 # stays an opaque blob on the relay hot path.
 _SETUP_TYPES = ('setup',)
 
+# Item types `FileLoggerReader.stats` needs the items of (sample fields,
+# schemas, markers) when a recording has no index.
+_UNPACKED_STATS_TYPES = ('sample', 'setup', 'marker')
+
+# Samples a `FileLoggerWriter` holds in a block before writing it.
+_MAX_BLOCK_SAMPLES = 4096
+
 # Session name used when the producer does not specify one.
 DEFAULT_SESSION = 'Default'
 
 
 class FileLoggerWriter:
-    def __init__(self, path, max_file_size_mb, compression_level=10, child=None):
+    """Writes logged batches to an indexed .zst recording (see `recording`).
+
+    Once a file reaches `max_file_size_mb` of compressed data (its blob file
+    included, see `blob_store`), it is closed and writing continues in the
+    next numbered segment: `path`, then 'name.0001.zst', 'name.0002.zst', ...
+    (see `recording.list_segments`). A falsy `max_file_size_mb` never
+    rotates. Numbered segments left by an earlier recording at `path` are
+    removed when the new one starts, except in retention mode (see below).
+
+    For always-on "black box" recording, `segment_duration_s` also rotates
+    segments by time, and `retention_mb` / `retention_s` delete the oldest
+    closed segments once all segments together, the open one and blob files
+    included, exceed that size, or once a segment was closed longer ago than
+    that. Segments left over from an earlier run at the same path count
+    towards the budget, and numbering continues after them. `freeze` moves
+    the retained window out of the ring so it is kept, e.g. when an incident
+    happens.
+
+    A new zstd frame is started every `frame_size_mb` of logged data or every
+    `frame_interval_s` seconds, so readers can seek to a time without
+    decompressing the file from the start.
+
+    Small batches compress poorly on their own. `dictionary` (bytes, or the
+    path of a file holding a zstd dictionary) compresses the recording with
+    it; with `train_dict_batches` > 0 a dictionary is trained from that many
+    first batches of each file instead, or from those logged within the
+    first `flush_interval_s` seconds if fewer, as batches held back for
+    training aren't on disk yet. Readers find it in the file header.
+
+    By default `log` packs and compresses on the caller's thread. With
+    `async_queue_mb` > 0 it only packs and hands the batch to a background
+    compression thread through a queue holding at most that many MB; when the
+    queue is full, `when_full='drop'` drops the batch (counted in
+    `dropped_batches` / `dropped_bytes`) and `when_full='block'` waits for
+    room. `queued_bytes` is the current queue fill. `compression_threads` > 0
+    additionally runs zstd's own multi-threaded compression.
+
+    Logged data reaches the file at most `flush_interval_s` seconds after
+    `log`, also when nothing else is logged afterwards, so a crash or power
+    loss only costs that last window. Readers recover everything before the
+    truncated tail of such a file. `None` leaves flushing to frame ends.
+
+    With `blob_store` the large binary fields of image, depth and video items
+    go to a companion '<segment>.blobs' file instead of being compressed
+    again with the timeseries (see `recording`); rotation, retention and
+    `freeze` keep it with its segment.
+
+    `sample_encoding` ('delta', 'xor' or 'raw') stores the numeric samples as
+    columnar blocks: delta-of-delta times and values as the delta to (or XOR
+    with) the previous sample, see `sample_blocks`. Smooth or quantized
+    signals compress several times better that way than as per-sample dicts.
+    The samples of each session and field layout are collected across `log`
+    calls, as live batches hold only a few, and their block is written once
+    `flush_interval_s` (or `frame_interval_s` without it) passed or it holds
+    4096 samples, and on `flush`, rotation and `close`; so blocks can end up
+    after items logged later. Readers expand them back into samples; integer
+    values come back as floats.
+    """
+
+    def __init__(self, path, max_file_size_mb, compression_level=10, child=None,
+                 frame_size_mb=4, frame_interval_s=10., dictionary=None,
+                 train_dict_batches=0, async_queue_mb=0, when_full='drop',
+                 compression_threads=0, segment_duration_s=None,
+                 retention_mb=None, retention_s=None, flush_interval_s=0.25,
+                 blob_store=False, sample_encoding=None):
         self.path = path
         self.max_file_size_mb = max_file_size_mb
-        self.is_full = False
         self.compression_level = compression_level
+        self.frame_size_mb = frame_size_mb
+        self.frame_interval_s = frame_interval_s
+        if dictionary is not None and not isinstance(dictionary, bytes):
+            dictionary = Path(dictionary).read_bytes()
+        self.dictionary = dictionary
+        self.train_dict_batches = train_dict_batches
+        self.compression_threads = compression_threads
+        self.flush_interval_s = flush_interval_s
+        self.blob_store = blob_store
+        self.sample_encoding = sample_encoding
+        # (session, layout) -> BlockBuilder of the samples not written yet,
+        # and when the first of them was added.
+        self._blocks = {}
+        self._blocks_since = None
+        # Sample schemas announced in the logged data (see `schema`), kept in
+        # the header and index of every segment.
+        self.schemas = {}
+        self.blobs = None
+        self._dirty = threading.Event()
+        self._stop_flush = threading.Event()
+        self._flush_thread = None
+        self.segment = 0
+        self.segment_path = None
+        self.segment_duration_s = segment_duration_s
+        self._segment_opened = 0.
         self.fh = None
         self.child = child
         self.swap_lock = threading.Lock()
 
+        assert when_full in ('drop', 'block'), \
+            "when_full must be either 'drop' or 'block'"
+        self.async_queue_bytes = int(async_queue_mb * 1024 * 1024)
+        self.when_full = when_full
+        self.queued_bytes = 0
+        self.dropped_batches = 0
+        self.dropped_bytes = 0
+        self._queue = deque()
+        self._queue_cond = threading.Condition()
+        self._compress_thread = None
+
+        # Retention ring: closed segments as (path, size, wall time closed),
+        # oldest first, and their total size.
+        self.retention_mb = retention_mb
+        self.retention_s = retention_s
+        self.retained = deque()
+        self.retained_bytes = 0
+        if self._retaining:
+            for index, path in numbered_segments(self.path):
+                size = _segment_size(path)
+                self.retained.append((path, size, os.stat(path).st_mtime))
+                self.retained_bytes += size
+                self.segment = index + 1
+            self._enforce_retention()
+
+    @property
+    def _retaining(self):
+        return bool(self.retention_mb or self.retention_s)
+
+    @property
+    def _open_bytes(self):
+        """Size of the open segment together with its blob file."""
+        if self.fh is None:
+            return 0
+        size = self.recording.bytes_written
+        if self.blobs is not None:
+            size += self.blobs.bytes_written
+        return size
+
     def set_session(self, name):
         # Sessions only matter for the websocket viewer; the file format stores
         # the session name per sample. Accept the call so Logger can run with a
@@ -51,73 +199,417 @@ class FileLoggerWriter:
             self.child.set_session(name)
 
     def init(self):
-        self.is_full = False
-        self.fh = open(self.path, "wb+")
-        self.cctx = zstandard.ZstdCompressor(level=self.compression_level)
-        self.compressor = self.cctx.stream_writer(self.fh)
+        if self.segment == 0 and not self._retaining:
+            self._remove_stale_segments()
+        self.segment_path = segment_path(self.path, self.segment)
+        self.fh = open(self.segment_path, "wb+")
+        if self.blob_store:
+            self.blobs = BlobWriter(open(blob_path(self.segment_path), 'wb'))
+        self._segment_opened = time.monotonic()
+        self.recording = RecordingWriter(
+            self.fh, self.compression_level,
+            frame_size_mb=self.frame_size_mb,
+            frame_interval_s=self.frame_interval_s,
+            dictionary=self.dictionary,
+            train_dict_batches=self.train_dict_batches,
+            threads=self.compression_threads,
+            flush_interval_s=self.flush_interval_s,
+            schemas=self.schemas)
+
+        if self.flush_interval_s is not None and self._flush_thread is None:
+            self._stop_flush.clear()
+            self._flush_thread = threading.Thread(
+                target=self._flush_loop, daemon=True)
+            self._flush_thread.start()
+
+    def _remove_stale_segments(self):
+        """Remove the numbered segments an earlier recording at `path` left,
+        which readers would otherwise take for segments of the new one."""
+        stale = [path for index, path in numbered_segments(self.path) if index]
+        if stale:
+            print(f'[file-writer] Removing {len(stale)} segments of an earlier '
+                  f'recording at {self.path}')
+        for path in stale:
+            _remove_segment(path)
+        # Segment 0 itself is truncated when opened, but not its blob file.
+        if not self.blob_store and os.path.exists(blob_path(self.path)):
+            os.remove(blob_path(self.path))
+
+    def _rotate(self):
+        """Close the current segment and continue in the next one."""
+        closed_path = self.segment_path
+        self._close_file()
+
+        if self._retaining:
+            self.retained.append(
+                (closed_path, _segment_size(closed_path), time.time()))
+            self.retained_bytes += self.retained[-1][1]
+            self._enforce_retention()
+        else:
+            print(f'[file-writer] Size limit of {self.max_file_size_mb} MB '
+                  f'reached, continuing in '
+                  f'{segment_path(self.path, self.segment + 1)}')
+
+        self.segment += 1
+        self.init()
+
+    def _enforce_retention(self):
+        """Delete the oldest closed segments that exceed the budget, which
+        the open segment counts towards too."""
+        budget = self.retention_mb * 1024 * 1024 if self.retention_mb else None
+        now = time.time()
+        open_bytes = self._open_bytes
 
-        self.file_size_thread = threading.Thread(target=self.check_file_size)
-        self.file_size_thread.start()
+        while self.retained:
+            path, size, closed = self.retained[0]
+            if not ((budget is not None and
+                     self.retained_bytes + open_bytes > budget) or
+                    (self.retention_s and now - closed > self.retention_s)):
+                break
 
-    def check_file_size(self):
-        while not self.is_full and self.fh:
-            self.check_path = self.path
-            path = Path(self.check_path)
+            self.retained.popleft()
+            self.retained_bytes -= size
+            _remove_segment(path)
 
-            if not path.exists():
-                break
+    def freeze(self, label=None):
+        """Keep the retained window: close the current segment and move it,
+        with all retained segments, into a new '<name>.frozen_<time>'
+        directory next to the recording, out of the retention ring.
 
-            file_size_mb = os.stat(path).st_size / (1024 * 1024)
+        Returns the directory.
+        """
+        self.drain()
 
-            # In case the file changed in the mean time, ignore this.
-            if self.check_path != self.path:
-                break
+        with self.swap_lock:
+            if self.fh is not None:
+                self._rotate()
 
-            if file_size_mb > self.max_file_size_mb:
-                self.is_full = True
-                break
+            p = Path(self.path)
+            stamp = time.strftime('%Y%m%d_%H%M%S')
+            suffix = f'_{label}' if label else ''
+            frozen_dir = p.with_name(f'{p.stem}.frozen_{stamp}{suffix}')
+            frozen_dir.mkdir(parents=True, exist_ok=True)
+
+            for path, _, _ in self.retained:
+                _move_segment(path, str(frozen_dir / Path(path).name))
+            self.retained.clear()
+            self.retained_bytes = 0
 
-            time.sleep(5)
+        print(f'[file-writer] Froze recording window into {frozen_dir}')
+        return str(frozen_dir)
 
     def reset(self, move_file_to=None):
-        with self.swap_lock:
-            self.close()
+        """Close the recording and start a new one.
 
-            if move_file_to:
-                os.rename(self.path, move_file_to)
+        `move_file_to` moves the closed recording there, every segment of it
+        ('moved.zst', 'moved.0001.zst', ...); otherwise it is overwritten by
+        the new recording at `path`. In retention mode the closed segment
+        joins the retained ones instead and numbering goes on; `move_file_to`
+        then moves all retained segments, like `freeze`.
+        """
+        self.drain()
+
+        with self.swap_lock:
+            closed_path = self.segment_path
+            self._close_file()
+
+            if closed_path is None:
+                pass  # Nothing written yet.
+            elif self._retaining:
+                # Retained segments keep their numbers, so the closed one
+                # joins them like on a rotation and numbering goes on.
+                self.retained.append(
+                    (closed_path, _segment_size(closed_path), time.time()))
+                self.retained_bytes += self.retained[-1][1]
+                if move_file_to:
+                    for index, (path, _, _) in enumerate(self.retained):
+                        _move_segment(path, segment_path(move_file_to, index))
+                    self.retained.clear()
+                    self.retained_bytes = 0
+                else:
+                    self._enforce_retention()
+                self.segment += 1
+            else:
+                # The segments of the closed recording, 0 up to the current one.
+                for index in range(self.segment + 1):
+                    path = segment_path(self.path, index)
+                    if move_file_to:
+                        _move_segment(path, segment_path(move_file_to, index))
+                    elif index:
+                        # Segment 0 is truncated when reopened.
+                        _remove_segment(path)
+                self.segment = 0
 
             self.init()
 
     def flush(self):
-        self.compressor.flush(zstandard.FLUSH_FRAME)
+        self.drain()
+
+        with self.swap_lock:
+            if self.fh is not None:
+                self._write_blocks()
+                self.recording.close_frame()
 
     def log(self, data):
         if self.child:
             self.child.log(data)
 
-        if self.is_full:
-            return
-
-        data_msgp = ormsgpack.packb(data, option=ormsgpack.OPT_SERIALIZE_NUMPY)
-        header = struct.pack('>I', len(data_msgp))
-
+        for item in data:
+            if is_schema_setup(item):
+                self.schemas[item['payload']['id']] = item['payload']
+
+        # Camera and depth frames are written as records of their own, so
+        # readers looking for anything else skip them without decoding. The
+        # batch is split into runs of heavy and other items to keep its order.
+        records = []
+        samples = []  # (item, layout) of the samples to collect in blocks
+        for heavy, items in groupby(
+                data, lambda item: item.get('type') in HEAVY_TYPES):
+            items = list(items)
+            if heavy and self.blob_store:
+                # Packed once their blobs are written, in `_write_records`,
+                # into the blob file of the segment they end up in.
+                records.append((None, items))
+                continue
+            if not heavy and self.sample_encoding is not None:
+                rest = []
+                for item in items:
+                    layout = item_layout(item)
+                    if layout is None:
+                        rest.append(item)
+                    else:
+                        samples.append((item, layout))
+                # Blocks logged as such are re-encoded.
+                items = encode_samples(rest, self.sample_encoding)
+                if not items:
+                    continue
+            records.append((ormsgpack.packb(
+                items, option=ormsgpack.OPT_SERIALIZE_NUMPY), items))
+
+        if self.async_queue_bytes > 0:
+            self._enqueue(records, samples)
+        else:
+            self._write_records(records, samples)
+
+    def log_entries(self, entries, chunk_items=1000, chunk_heavy_items=32):
+        """Log a stream of entries (e.g. read from other recordings) in
+        batches of `chunk_items` (see `log`), or fewer holding
+        `chunk_heavy_items` images or depth frames, to bound the memory held.
+        Returns the number of entries logged."""
+        count = 0
+        chunk = []
+        heavy = 0
+        for entry in entries:
+            chunk.append(entry)
+            heavy += entry.get('type') in HEAVY_TYPES
+            if len(chunk) >= chunk_items or heavy >= chunk_heavy_items:
+                self.log(chunk)
+                count += len(chunk)
+                chunk = []
+                heavy = 0
+        if chunk:
+            self.log(chunk)
+            count += len(chunk)
+        return count
+
+    def _write_records(self, records, samples=()):
         with self.swap_lock:
             if self.fh is None:
                 self.init()
 
-            self.compressor.write(header)
-            self.compressor.write(data_msgp)
-
+            for data_msgp, items in records:
+                if data_msgp is None:
+                    items = [self.blobs.externalize(item) for item in items]
+                    # The blobs reach the file before the records refering
+                    # to them.
+                    self.blobs.flush()
+                    data_msgp = ormsgpack.packb(
+                        items, option=ormsgpack.OPT_SERIALIZE_NUMPY)
+                self.recording.write(data_msgp, items)
+            for item, layout in samples:
+                self._add_block_sample(item, layout)
+            if self._blocks_due() == 0.:
+                self._write_blocks()
+            self._dirty.set()
+
+            if (self.max_file_size_mb and self._open_bytes >=
+                    self.max_file_size_mb * 1024 * 1024) or \
+                    (self.segment_duration_s and time.monotonic() -
+                     self._segment_opened >= self.segment_duration_s):
+                self._rotate()
+            elif self.retention_mb and self.retained:
+                self._enforce_retention()
+
+    def _add_block_sample(self, item, layout):
+        key = (item.get('session'), layout)
+        builder = self._blocks.get(key)
+        if builder is None:
+            builder = self._blocks[key] = BlockBuilder(*key)
+        try:
+            builder.add(item['time'], item['payload'].values())
+        except (TypeError, ValueError):
+            # E.g. a list mixing numbers and strings; kept as it is.
+            self.recording.write(ormsgpack.packb(
+                [item], option=ormsgpack.OPT_SERIALIZE_NUMPY), [item])
+            return
+        if self._blocks_since is None:
+            self._blocks_since = time.monotonic()
+        if builder.n >= _MAX_BLOCK_SAMPLES:
+            self._write_blocks()
+
+    def _blocks_due(self):
+        """Seconds until the collected blocks are due to be written, None if
+        there are none."""
+        if self._blocks_since is None:
+            return None
+        hold_s = self.flush_interval_s if self.flush_interval_s is not None \
+            else self.frame_interval_s
+        return max(0., self._blocks_since + hold_s - time.monotonic())
+
+    def _write_blocks(self):
+        """Write the collected blocks as one record."""
+        items = [builder.block(self.sample_encoding)
+                 for builder in self._blocks.values()]
+        self._blocks = {}
+        self._blocks_since = None
+        if items:
+            self.recording.write(ormsgpack.packb(
+                items, option=ormsgpack.OPT_SERIALIZE_NUMPY), items)
+
+    def _flush_loop(self):
+        # Sleeps on `_dirty` while nothing is logged, so an idle writer
+        # doesn't wake up.
+        while True:
+            self._dirty.wait()
+            with self.swap_lock:
+                if self._stop_flush.is_set():
+                    return
+                if self.fh is None:
+                    self._dirty.clear()
+                    continue
+                dues = [due for due in
+                        (self.recording.flush_due, self._blocks_due())
+                        if due is not None]
+                if not dues:
+                    self._dirty.clear()
+                    continue
+                due = min(dues)
+                if due == 0.:
+                    # Collected blocks go straight to the file with the
+                    # rest, they waited long enough.
+                    if self._blocks_due() == 0.:
+                        self._write_blocks()
+                    self.recording.flush_block()
+                    continue
+            self._stop_flush.wait(due)
+
+    def _enqueue(self, records, samples):
+        size = sum(len(data_msgp) if data_msgp is not None else
+                   _binary_size(items) for data_msgp, items in records)
+        # Roughly the float64 columns of the samples.
+        size += sum(8 * (1 + sum(dim or 1 for _, dim in layout))
+                    for _, layout in samples)
+
+        with self._queue_cond:
+            if self._compress_thread is None:
+                self._compress_thread = threading.Thread(
+                    target=self._compress_loop, daemon=True)
+                self._compress_thread.start()
+
+            # A batch larger than the whole queue is still let through once
+            # the queue is empty.
+            while self.queued_bytes > 0 and \
+                    self.queued_bytes + size > self.async_queue_bytes:
+                if self.when_full == 'drop':
+                    self.dropped_batches += 1
+                    self.dropped_bytes += size
+                    return
+                self._queue_cond.wait()
+
+            self.queued_bytes += size
+            self._queue.append((records, samples, size))
+            self._queue_cond.notify_all()
+
+    def _compress_loop(self):
+        while True:
+            with self._queue_cond:
+                while not self._queue:
+                    self._queue_cond.wait()
+                records, samples, size = self._queue[0]
 
-    def close(self):
+            try:
+                self._write_records(records, samples)
+            except Exception as e:
+                print(f'[file-writer] Failed to write batch: {e}')
+
+            # Only dequeue once written, so drain() also waits for the batch
+            # being compressed right now.
+            with self._queue_cond:
+                self._queue.popleft()
+                self.queued_bytes -= size
+                self._queue_cond.notify_all()
+
+    def drain(self):
+        """Wait until the background compression thread wrote every queued
+        batch. A no-op for synchronous writers."""
+        with self._queue_cond:
+            while self._queue:
+                self._queue_cond.wait()
+
+    def _close_file(self):
         if self.fh is None:
             return
 
-        self.flush()
-        self.compressor.close()
+        self._write_blocks()
+        self.recording.close()
         self.fh.close()
         self.fh = None
-        self.is_full = False
+        if self.blobs is not None:
+            self.blobs.fh.close()
+            self.blobs = None
+
+    def close(self):
+        self.drain()
+
+        with self.swap_lock:
+            self._close_file()
+            # Set under the lock, so the flush thread can't clear `_dirty`
+            # again before seeing the stop.
+            self._stop_flush.set()
+            self._dirty.set()
+
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+            self._flush_thread = None
+
+
+def _move_segment(path, to):
+    """Rename a segment together with its blob file."""
+    for name, new_name in ((path, to), (blob_path(path), blob_path(to))):
+        if os.path.exists(name):
+            os.rename(name, new_name)
+
+
+def _remove_segment(path):
+    for name in (path, blob_path(path)):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+def _segment_size(path):
+    """Size of a recording segment together with its blob file."""
+    size = os.path.getsize(path)
+    if os.path.exists(blob_path(path)):
+        size += os.path.getsize(blob_path(path))
+    return size
+
+
+def _binary_size(items):
+    """Rough packed size of items, counting their binary fields only."""
+    return sum(len(value) for item in items for value in item.values()
+               if isinstance(value, (bytes, bytearray, memoryview)))
 
 
 def list2numpy(data):
@@ -130,63 +622,498 @@ def list2numpy(data):
     return data
 
 
+def _decode_frame_entries(path, frame, types, sessions):
+    """Process pool worker: the matching entries of one indexed frame.
+
+    Returned re-packed as one msgpack blob: unpacking that in the parent is
+    far cheaper than unpickling the decoded entries.
+    """
+    reader = FileLoggerReader(path, to_numpy=False)
+    try:
+        return ormsgpack.packb([
+            entry
+            for batch in reader._frame_batches(frame, types=types,
+                                               sessions=sessions)
+            for entry in batch
+            if entry_matches(entry, types=types, sessions=sessions)])
+    finally:
+        reader.close()
+
+
+def _decode_frame_columns(path, frame, fields, session, dtype):
+    """Process pool worker: the columns of one indexed frame."""
+    reader = FileLoggerReader(path)
+    sessions = [session] if session is not None else None
+    try:
+        builder = ColumnBuilder(fields, dtype)
+        for batch in reader._frame_batches(frame, types=['sample'],
+                                           sessions=sessions, expand=False):
+            for entry in batch:
+                builder.add_entry(entry, session)
+        return builder.finish()
+    finally:
+        reader.close()
+
+
 class FileLoggerReader:
-    def __init__(self, path, child=None):
+    """Reads recordings written by FileLoggerWriter or the Recorder.
+
+    The reader is an iterator over the recorded entries (`for entry in
+    reader`), continuing from the current position, e.g. after `seek_time`.
+    `iter_batches` yields whole decoded batches instead, which saves the
+    per-entry overhead in bulk processing. With `to_numpy` (the default)
+    lists of numbers in the entries are converted to numpy arrays. Binary
+    fields kept in the recording's blob file are read back when their entry
+    is returned, and sample blocks and packed samples come out as plain
+    'sample' entries.
+    """
+
+    def __init__(self, path, child=None, to_numpy=True):
         self.path = path
-        self.buffer = []
+        self.to_numpy = to_numpy
+        self.buffer = deque()
+        self.blobs = BlobReader(blob_path(path))
         self._setup()
 
     def _setup(self):
         self.fh = open(self.path, "rb")
-        self.dctx = zstandard.ZstdDecompressor()
-        self.reader = self.dctx.stream_reader(self.fh)
+        # The header holds the zstd dictionary the recording was compressed
+        # with, if any.
+        self.header = read_header(self.fh)
+        self.dctx = decompressor(self.header)
+        # Recordings written by FileLoggerWriter carry a trailing frame index.
+        # Older files are a single zstd frame without one and can only be
+        # read by a linear scan.
+        self.index = read_index(self.fh)
+        self.fh.seek(0)
+        self.reader = FrameStreamReader(self.fh, self.dctx)
+
+        # Sample schemas, from the header and index and as met in the stream.
+        self.schemas = {}
+        self._schemas_scanned = False
+        for source in (self.header, self.index):
+            for payload in (source or {}).get('schemas', ()):
+                self._add_schema(payload)
+
+    def _add_schema(self, payload):
+        self.schemas[payload['id']] = SampleSchema(payload['fields'], payload['id'])
+
+    def _schema(self, schema_id):
+        if schema_id not in self.schemas and not self._schemas_scanned:
+            self._scan_schemas()
+
+        schema = self.schemas.get(schema_id)
+        if schema is None:
+            print(f'[reader] Dropping packed samples of unknown schema {schema_id}.')
+        return schema
+
+    def _scan_schemas(self):
+        """Collect the schemas announced anywhere in the recording, for files
+        whose header and index don't list them (e.g. from the Recorder)."""
+        self._schemas_scanned = True
+        with open(self.path, 'rb') as fh:
+            stream = FrameStreamReader(fh, self.dctx)
+            while True:
+                record = read_record(stream)
+                if record is None:
+                    return
+
+                envelope, payload = record
+                if envelope is not None and 'setup' not in envelope['types']:
+                    continue
+                for item in ormsgpack.unpackb(payload):
+                    if isinstance(item, dict) and is_schema_setup(item):
+                        self._add_schema(item['payload'])
+
+    def _expand(self, batch, expand=True):
+        """A raw batch with its sample blocks and packed samples expanded into
+        samples. With `expand` False packed samples become (raw) blocks
+        instead, for `ColumnBuilder`."""
+        packed = False
+        for item in batch:
+            kind = item.get('type')
+            if kind in ('sample_block', 'packed_samples'):
+                packed = True
+            elif kind == 'setup' and is_schema_setup(item):
+                self._add_schema(item['payload'])
+        if not packed:
+            return batch
+
+        res = []
+        for item in batch:
+            kind = item.get('type')
+            if kind == 'packed_samples':
+                schema = self._schema(item['schema'])
+                if schema is None:
+                    continue
+                if expand:
+                    res.extend(schema.expand(item))
+                else:
+                    res.append(make_block(item.get('session'),
+                                          *schema.columns(item['rows']), 'raw'))
+            elif kind == 'sample_block' and expand:
+                res.extend(expand_block(item))
+            else:
+                res.append(item)
+        return res
+
+    @property
+    def frames(self):
+        """Index entries of the zstd frames, None for unindexed files."""
+        return self.index['frames'] if self.index else None
+
+    def _frame_batches(self, frame, t0=None, t1=None, types=None, sessions=None,
+                       expand=True):
+        """Yield the raw batches of an indexed frame, skipping (without
+        unpacking) those whose envelope rules out the query. See `_expand`
+        for `expand`."""
+        raw = read_frame_bytes(self.fh, frame, self.dctx)
+        for envelope, payload in iter_records(raw):
+            if envelope is not None and \
+                    not frame_matches(envelope, t0, t1, types, sessions):
+                continue
+            yield self._expand(ormsgpack.unpackb(payload), expand)
+
+    def _frame_entries(self, frame):
+        for batch in self._frame_batches(frame):
+            yield from batch
+
+    def _convert(self, entry):
+        if entry.get('type') in HEAVY_TYPES:
+            self.blobs.resolve(entry)
+        return list2numpy(entry) if self.to_numpy else entry
+
+    def read_frame(self, frame_idx):
+        """Decode all entries of a single indexed frame."""
+        return [self._convert(entry)
+                for entry in self._frame_entries(self.frames[frame_idx])]
 
     def reset(self):
         self.fh.seek(0)
-        self.buffer = []
-        self.reader = self.dctx.stream_reader(self.fh)
+        self.buffer = deque()
+        self.reader = FrameStreamReader(self.fh, self.dctx)
 
-    def next(self):
-        # If there are no more buffered entries, then read the next one.
-        if len(self.buffer) == 0:
-            header = self.reader.read(4)
+    def _read_batch(self, t0=None, t1=None, types=None, sessions=None,
+                    expand=True):
+        """The next batch of raw (unconverted) entries, None at the end.
 
-            self.header = header
-
-            if not header:
+        Batches whose envelope rules out the query are skipped unpacked.
+        See `_expand` for `expand`.
+        """
+        while True:
+            record = read_record(self.reader)
+            if record is None:
                 return None
 
-            next_size = struct.unpack('>I', header)[0]
+            envelope, payload = record
+            if envelope is not None and \
+                    not frame_matches(envelope, t0, t1, types, sessions):
+                continue
+
+            return self._expand(ormsgpack.unpackb(payload), expand)
 
-            self.buffer = ormsgpack.unpackb(self.reader.read(next_size))
+    def next(self):
+        # If there are no more buffered entries, then read the next one.
+        while len(self.buffer) == 0:
+            batch = self._read_batch()
+            if batch is None:
+                return None
+            self.buffer = deque(batch)
 
         # Return the first entry from the buffered reads. Convert lists
         # to numpy arrays.
-        return list2numpy(self.buffer.pop(0))
+        return self._convert(self.buffer.popleft())
 
-    def read_all(self, entry_filter_fn=lambda x: True, reducer_fn=None):
-        self.reset()
-        data = []
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        entry = self.next()
+        if entry is None:
+            raise StopIteration
+        return entry
+
+    def iter_batches(self, types=None, sessions=None):
+        """Yield the remaining entries one decoded batch (list) at a time.
+
+        Entries already buffered by `next` or `seek_time` come first. With
+        `types` / `sessions` only matching entries are returned, and batches
+        whose envelope holds none of them are skipped without decoding.
+        """
+        def matches(entry):
+            return entry_matches(entry, types=types, sessions=sessions)
+
+        if self.buffer:
+            batch = list(self.buffer)
+            self.buffer = deque()
+            yield [self._convert(entry) for entry in batch if matches(entry)]
 
         while True:
-            entry = self.next()
+            batch = self._read_batch(types=types, sessions=sessions)
+            if batch is None:
+                return
+            if types is not None or sessions is not None:
+                batch = [entry for entry in batch if matches(entry)]
+            yield [self._convert(entry) for entry in batch]
+
+    def seek_time(self, t):
+        """Position the reader so `next` returns the first entry at time >= t.
 
-            if entry is None:
+        Entries without a time that come before it are skipped. With a frame
+        index only the frame holding `t` is decoded; unindexed files are
+        scanned from the start.
+        """
+        self.reset()
+
+        frames = self.frames
+        if frames:
+            for frame in frames:
+                if frame['items'] and (frame['t_max'] is None or frame['t_max'] < t):
+                    continue
+                self.fh.seek(frame['offset'])
+                self.reader = FrameStreamReader(self.fh, self.dctx)
                 break
+            else:
+                self.fh.seek(self.index['data_size'])
+                self.reader = FrameStreamReader(self.fh, self.dctx)
+                return
 
-            if not entry_filter_fn(entry):
+        while True:
+            batch = self._read_batch(t0=t)
+            if batch is None:
+                return
+
+            for i, entry in enumerate(batch):
+                entry_t = item_time(entry)
+                if entry_t is not None and entry_t >= t:
+                    self.buffer = deque(batch[i:])
+                    return
+
+    def _iter_raw_batches(self, t0=None, t1=None, types=None, sessions=None,
+                          expand=True):
+        """Yield raw (unconverted) batches from the start of the recording,
+        skipping the indexed frames and enveloped batches that can't hold
+        entries matching the query. Batches are not filtered per entry."""
+        frames = self.frames
+        if frames is None:
+            self.reset()
+            while True:
+                batch = self._read_batch(t0, t1, types, sessions, expand)
+                if batch is None:
+                    return
+                yield batch
+
+        for frame in frames:
+            if not frame_matches(frame, t0, t1, types, sessions):
                 continue
+            yield from self._frame_batches(
+                frame, t0, t1, types, sessions, expand)
+
+    def _map_frames(self, fn, frames, workers, *args):
+        """Run `fn(path, frame, *args)` for every frame in a process pool,
+        returning the results in frame (i.e. recording) order."""
+        n = len(frames)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(
+                fn, [self.path] * n, frames, *[[arg] * n for arg in args],
+                chunksize=max(1, n // (4 * workers))))
+
+    def to_columns(self, fields=None, session=None, dtype=np.float64,
+                   cache=False, workers=None):
+        """The recorded samples as columns, in a single streaming pass.
+
+        Returns `{'time': float64[N], field: dtype[N, dim]}` for every numeric
+        payload field (or only `fields`) of the samples of `session` (all
+        sessions if None). Missing values are NaN. See `ColumnBuilder`.
+
+        With `cache` (True, or the directory to use) all columns are written
+        to a sidecar `<path>.columns` directory the first time, and later
+        calls return read-only memory-mapped views of them instead of
+        decoding the recording. See `ColumnCache`.
+
+        With `workers` > 1 the frames of an indexed recording are decoded in
+        that many processes and their columns concatenated in order.
+        """
+        if cache:
+            column_cache = ColumnCache(
+                self.path, cache if not isinstance(cache, bool) else None)
+            columns = column_cache.load(session, dtype, fields)
+            if columns is not None:
+                return columns
 
-            if reducer_fn is not None:
-                entry = reducer_fn(entry)
+            try:
+                column_cache.save(
+                    self.to_columns(None, session, dtype, workers=workers),
+                    session, dtype)
+            except OSError as e:
+                print(f'[reader] Could not write column cache: {e}')
+                return self.to_columns(fields, session, dtype, workers=workers)
+            return column_cache.load(session, dtype, fields)
+
+        sessions = [session] if session is not None else None
+
+        if workers and workers > 1 and self.frames:
+            frames = [frame for frame in self.frames
+                      if frame_matches(frame, types=['sample'], sessions=sessions)]
+            return concat_columns(self._map_frames(
+                _decode_frame_columns, frames, workers, fields, session, dtype),
+                dtype)
+
+        return next(self.iter_columns(fields, session, dtype=dtype))
+
+    def iter_columns(self, fields=None, session=None, t0=None, t1=None,
+                     dtype=np.float64, chunk_samples=None):
+        """Yield the samples as columns like `to_columns`, in chunks of about
+        `chunk_samples` samples (one chunk if None) to bound the memory held,
+        at least one, possibly empty.
+
+        Only the frames and batches overlapping [t0, t1] are decoded; they
+        may hold samples outside of it.
+        """
+        sessions = [session] if session is not None else None
+        builder = ColumnBuilder(fields, dtype)
+        done = 0
+        for batch in self._iter_raw_batches(t0, t1, ['sample'], sessions,
+                                            expand=False):
+            for entry in batch:
+                builder.add_entry(entry, session)
+            if chunk_samples and builder.n >= chunk_samples:
+                done += builder.n
+                yield builder.finish()
+                builder = ColumnBuilder(fields, dtype)
+        if builder.n or not done:
+            yield builder.finish()
+
+    def read_range(self, t0=None, t1=None, types=None, sessions=None):
+        """All entries with t0 <= time <= t1, optionally of the given `types`
+        and `sessions` only.
+
+        Only the frames whose indexed time span overlaps the window (and that
+        hold one of the types / sessions) are decoded, and within them only
+        the batches whose envelope does. Unindexed files are scanned linearly.
+        """
+        data = []
+        for batch in self._iter_raw_batches(t0, t1, types, sessions):
+            data.extend(self._convert(entry) for entry in batch
+                        if entry_matches(entry, t0, t1, types, sessions))
+        return data
 
-            data.append(entry)
+    def read_all(self, entry_filter_fn=lambda x: True, reducer_fn=None,
+                 types=None, sessions=None, workers=None):
+        """All entries of the recording, in recorded order.
+
+        With `workers` > 1 the frames of an indexed recording are decompressed
+        and filtered by `types` / `sessions` in that many processes. Building
+        the entries (and `entry_filter_fn` / `reducer_fn`) still happens in
+        this process, so the gain is largest for selective reads; bulk numeric
+        loads should use `to_columns(workers=...)`.
+        """
+        self.reset()
+        data = []
+
+        if workers and workers > 1 and self.frames:
+            frames = [frame for frame in self.frames
+                      if frame_matches(frame, types=types, sessions=sessions)]
+            batches = (
+                [self._convert(entry) for entry in ormsgpack.unpackb(packed)]
+                for packed in self._map_frames(
+                    _decode_frame_entries, frames, workers, types, sessions))
+        else:
+            batches = self.iter_batches(types, sessions)
+
+        for batch in batches:
+            for entry in batch:
+                if not entry_filter_fn(entry):
+                    continue
+
+                if reducer_fn is not None:
+                    entry = reducer_fn(entry)
+
+                data.append(entry)
 
         return data
 
+    def stats(self):
+        """Summary of the recording: time span, sessions, item count and bytes
+        per type and per camera, sample fields per session and markers.
+
+        Recordings indexed by this version carry it in their index, so
+        nothing is decoded. Other files are summarized in one streaming pass
+        over their record envelopes; only records holding samples, setups or
+        markers, or of several types, are unpacked (sample blocks and binary
+        data left as they are). Without the index, images and depth frames
+        are therefore not counted per camera. Bytes are uncompressed, see
+        `RecordingStats`.
+        """
+        stats = (self.index or {}).get('stats')
+        if stats is not None:
+            frames = self.frames
+            records = sum(frame['records'] for frame in frames)
+            raw_size = sum(frame['raw_size'] for frame in frames)
+            items = sum(frame['items'] for frame in frames)
+            times = [frame[key] for frame in frames for key in ('t_min', 't_max')
+                     if frame[key] is not None]
+            t_min, t_max = (min(times), max(times)) if times else (None, None)
+            sessions = {s for frame in frames for s in frame['sessions']}
+        else:
+            totals = FrameStats()
+            content = RecordingStats(
+                {id: schema.to_payload() for id, schema in self.schemas.items()})
+            with open(self.path, 'rb') as fh:
+                stream = FrameStreamReader(fh, self.dctx)
+                while True:
+                    record = read_record(stream)
+                    if record is None:
+                        break
+                    envelope, payload = record
+                    if envelope is not None:
+                        totals.add(envelope, len(payload))
+                        kinds = envelope['types']
+                        if len(kinds) == 1 and \
+                                kinds[0] not in _UNPACKED_STATS_TYPES:
+                            content.add_summary(envelope, len(payload))
+                            continue
+
+                    batch = ormsgpack.unpackb(payload)
+                    for item in batch:
+                        if isinstance(item, dict) and is_schema_setup(item):
+                            content.schemas[item['payload']['id']] = item['payload']
+                    if envelope is None:
+                        totals.add(summarize(batch), len(payload))
+                    content.add(batch, len(payload))
+            stats = content.to_dict()
+            records, raw_size, items = totals.records, totals.raw_size, totals.items
+            t_min, t_max = totals.t_min, totals.t_max
+            sessions = totals.sessions
+
+        fields = {}
+        for session, name, dim in stats['fields']:
+            fields.setdefault(session, {})[name] = dim
+        blobs = blob_path(self.path)
+        return {
+            'path': str(self.path),
+            'bytes': os.path.getsize(self.path),
+            'blob_bytes': os.path.getsize(blobs) if os.path.exists(blobs) else 0,
+            'indexed': self.index is not None,
+            'frames': len(self.frames) if self.frames else 0,
+            'records': records,
+            'raw_bytes': raw_size,
+            'items': items,
+            't_min': t_min,
+            't_max': t_max,
+            'sessions': sorted(sessions),
+            'types': {kind: {'items': n, 'bytes': size}
+                      for kind, n, size in stats['types']},
+            'cameras': {name: {'items': n, 'bytes': size}
+                        for name, n, size in stats['cameras']},
+            'fields': fields,
+            'markers': [tuple(marker) for marker in stats['markers']],
+        }
+
     def close(self):
         self.reader.close()
         self.fh.close()
+        self.blobs.close()
 
 
 class WebsocketWriter:
@@ -401,6 +1328,95 @@ class SubprocessWriter:
     def reset(self, idx=None):
         self._send(('reset', idx))
 
+# Conversions of a `_LogPlan` entry.
+_SKIP, _STORE, _FLOAT, _COPY, _LIST, _TO_LOG_DICT, _NESTED, _UNSUPPORTED = \
+    range(8)
+
+# Key layouts `Logger._log_dict` keeps plans for.
+_MAX_LOG_PLANS = 64
+
+
+class _LogPlanMismatch(ValueError):
+    pass
+
+
+class _LogPlan:
+    """How `Logger` converts the dicts it logs, worked out once from an
+    example: per key the logged name, the value type and its conversion.
+    Nested dicts are flattened into 'a/b' keys through sub-plans.
+
+    `convert` then only checks that the keys and the exact value types are
+    the example's, raising a `_LogPlanMismatch` (a ValueError) otherwise.
+    """
+
+    def __init__(self, obj, loggable_classes, prefix=''):
+        self.keys = tuple(obj)
+        self.entries = [self._entry(prefix + key, value, loggable_classes)
+                        for key, value in obj.items()]
+
+    @staticmethod
+    def _entry(name, value, loggable_classes):
+        val_type = type(value)
+        key = name.rpartition('/')[2]
+        if name == 'time':  # HACK: Time is just a value, not an array.
+            return name, None, _STORE, None
+        if key.startswith('_'):
+            return name, None, _SKIP, None
+
+        if issubclass(val_type, (float, int, bool, str)):
+            op, arg = _STORE, None
+        elif issubclass(val_type, np.generic):
+            op, arg = _FLOAT, None
+        elif issubclass(val_type, np.ndarray) and value.ndim == 1:
+            op, arg = _COPY, None
+        elif issubclass(val_type, dict):
+            op, arg = _NESTED, _LogPlan(value, loggable_classes, name + '/')
+        elif issubclass(val_type, tuple(loggable_classes)):
+            op, arg = _TO_LOG_DICT, None
+        elif issubclass(val_type, list):
+            op, arg = _LIST, None
+        else:
+            op, arg = _UNSUPPORTED, None
+        return name, val_type, op, arg
+
+    def convert(self, obj, silent_error, res=None):
+        res = {} if res is None else res
+        values = tuple(obj.values())
+        if tuple(obj) != self.keys:
+            raise _LogPlanMismatch(
+                f'Logged keys {list(obj)} differ from the schema\'s '
+                f'{list(self.keys)}.')
+
+        for (name, val_type, op, arg), value in zip(self.entries, values):
+            if op is _SKIP:
+                continue
+            if val_type is not None and type(value) is not val_type:
+                raise _LogPlanMismatch(
+                    f"Logged {type(value).__name__} for '{name}', the schema "
+                    f"has {val_type.__name__}.")
+
+            if op is _STORE:
+                res[name] = value
+            elif op is _FLOAT:
+                res[name] = float(value)
+            elif op is _COPY:
+                if value.ndim != 1:
+                    raise _LogPlanMismatch(
+                        f"Logged a {value.ndim}d array for '{name}'.")
+                res[name] = value.copy()
+            elif op is _NESTED:
+                arg.convert(value, silent_error, res)
+            elif op is _TO_LOG_DICT:
+                res[name] = value.to_log_dict(name)
+            elif op is _LIST:
+                if len(value) > 0 and not np.isscalar(value[0]):
+                    continue
+                res[name] = np.array(value, np.float32)
+            elif not silent_error:
+                raise ValueError(f"Asked to log unsupported value ({str(value)}) for path '{name}'.")
+        return res
+
+
 class Logger(threading.Thread):
     @staticmethod
     def start_server():
@@ -408,8 +1424,10 @@ class Logger(threading.Thread):
         return writer
 
     @staticmethod
-    def to_file(path, file_size_mb, child=None, compression_level=10):
-        writer = FileLoggerWriter(path, file_size_mb, compression_level, child)
+    def to_file(path, file_size_mb, child=None, compression_level=10, **kwargs):
+        # kwargs: further FileLoggerWriter options, e.g. async_queue_mb.
+        writer = FileLoggerWriter(path, file_size_mb, compression_level, child,
+                                  **kwargs)
         return writer
 
     @staticmethod
@@ -417,21 +1435,65 @@ class Logger(threading.Thread):
         return SubprocessWriter()
 
     def __init__(self, server, layout_def=None, start=True, make_session_active=True,
-                 session=None):
+                 session=None, intern_schema=False, max_batch_latency=0.001,
+                 max_batch_items=1000, max_batch_bytes=4 * 1024 * 1024,
+                 flush_types=('image', 'command'), sample_blocks=False,
+                 sampling=None, sinks=()):
         super().__init__()
 
         self.server = server
         self.session_name = session or DEFAULT_SESSION
 
+        # The flush thread sleeps until items are logged, then sends them
+        # once the oldest waited `max_batch_latency` seconds, so items logged
+        # close together go out as one batch. A batch reaching
+        # `max_batch_items` items or `max_batch_bytes` of binary data (images,
+        # depth), or holding an item of `flush_types`, is sent right away.
+        self.max_batch_latency = max_batch_latency
+        self.max_batch_items = max_batch_items
+        self.max_batch_bytes = max_batch_bytes
+        self.flush_types = frozenset(flush_types)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._pending_count = 0  # Items and samples in blocks.
+        self._pending_bytes = 0
+        self._pending_since = 0.
+        self._flush_now = False
+        self._keep_running = True
+
+        # With `sample_blocks` consecutive `log` calls with the same fields
+        # are accumulated into columns and sent as one 'sample_block' per
+        # batch (see `sample_blocks`) instead of one 'sample' item each.
+        self.sample_blocks = sample_blocks
+        self._blocks = {}  # layout -> BlockBuilder of the pending batch
+
+        # With `intern_schema` numeric samples are sent as 'packed_samples'
+        # against a schema announced once through the setup channel, instead
+        # of repeating every field name per sample (see `schema`).
+        self.intern_schema = intern_schema
+
+        # Batches go to `server` and to the writers of `sinks`, given as
+        # `(writer, sampling)` pairs. A sink's sampling policy (a
+        # `SamplingPolicy` or its rules, see `sampling`) thins out its samples
+        # before they are packed, e.g. to send the viewer 60 Hz of a 1 kHz log
+        # written to a file at full rate:
+        #   Logger(file_writer, sinks=[(ws_writer, {'*': Decimate(1 / 60)})])
+        self._sinks = [self._sink(server, sampling)] + [
+            self._sink(writer, policy) for writer, policy in sinks]
+
         # Only identifies who registered a setup, for debugging. Registered
         # setups outlive the producer: like the timeseries and images already
         # in the viewer, a scene stays put when its producer goes away.
         self.producer_id = uuid.uuid4().hex
 
-        server.set_session(self.session_name)
+        for writer, _, _ in self._sinks:
+            writer.set_session(self.session_name)
 
-        self.log_queue = queue.Queue()
         self.loggable_value_classes = [RawMesh, Scene, PointCloud]
+        # Converters of logged dicts: per key layout, or fixed by
+        # `compile_schema`.
+        self._log_plans = {}
+        self._schema = None
 
         # Launching a session announces it to the server (registering it in
         # the live-session list, evicting the stalest one if there are more
@@ -452,42 +1514,128 @@ class Logger(threading.Thread):
         if start:
             self.start()
 
+    def _sink(self, writer, sampling):
+        if isinstance(sampling, dict):
+            sampling = SamplingPolicy(sampling)
+        interner = SchemaInterner(
+            lambda payload: self._setup_item(
+                'set', kind='schema', key=str(payload['id']), payload=payload)
+        ) if self.intern_schema else None
+        return writer, sampling, interner
+
     def _send_data(self, data):
-        self.server.log(data)
+        for writer, sampling, interner in self._sinks:
+            batch = data
+            if sampling is not None:
+                batch = sampling.apply(batch)
+            if interner is not None:
+                batch = interner.intern(batch)
+            if batch:
+                writer.log(batch)
+
+    @property
+    def keep_running(self):
+        return self._keep_running
+
+    @keep_running.setter
+    def keep_running(self, value):
+        # Wakes the flush thread, which sends what is left and exits.
+        with self._cond:
+            self._keep_running = value
+            self._cond.notify()
 
     def run(self):
         while self.keep_running:
+            with self._cond:
+                while not self._pending_count and self._keep_running:
+                    self._cond.wait()
+                deadline = self._pending_since + self.max_batch_latency
+                while not self._flush_now and self._keep_running:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
             self.flush()
-            time.sleep(0.001)
 
     _flush_debug_last_print = 0
 
     def flush(self):
-        # Only send data if there is any.
-        item_to_log = []
-        while True:
-            try:
-                item_to_log.append(self.log_queue.get_nowait())
-            except queue.Empty:
-                break
+        with self._cond:
+            item_to_log = self._pending
+            self._pending = []
+            self._pending_count = 0
+            self._pending_bytes = 0
+            self._flush_now = False
+            if self._blocks:
+                self._blocks = {}
+                item_to_log = [
+                    item.block() if isinstance(item, BlockBuilder) else item
+                    for item in item_to_log
+                    if not isinstance(item, BlockBuilder) or item.n]
 
+        # Only send data if there is any.
         if len(item_to_log) > 0:
             now = time.time()
             img_count = sum(1 for item in item_to_log if item.get('type') == 'image')
             if now - Logger._flush_debug_last_print >= 2.0 and img_count > 0:
                 # Check age of images in queue
                 img_ages = [now - item['time'] for item in item_to_log if item.get('type') == 'image']
-                print(f"[logger-flush] queue_depth={self.log_queue.qsize()}, "
-                      f"flushing {len(item_to_log)} items ({img_count} imgs), "
+                print(f"[logger-flush] flushing {len(item_to_log)} items "
+                      f"({img_count} imgs), "
                       f"img_age: avg={sum(img_ages)/len(img_ages):.3f}s max={max(img_ages):.3f}s")
                 Logger._flush_debug_last_print = now
-            self._send_data(item_to_log)
+            # Items logged while the flush thread was waking up may have grown
+            # the batch past its limit.
+            for i in range(0, len(item_to_log), self.max_batch_items):
+                self._send_data(item_to_log[i:i + self.max_batch_items])
 
     def _append_log(self, data):
         # Every item carries its session so the viewer can file it into the
         # right per-session store.
         data.setdefault('session', self.session_name)
-        self.log_queue.put(data)
+        with self._cond:
+            self._pending.append(data)
+            if data.get('type') in HEAVY_TYPES:
+                self._pending_bytes += _binary_size((data,))
+            self._wake(data.get('type'))
+
+    def _wake(self, kind):
+        """Count a pending item (of type `kind`) and wake the flush thread if
+        the batch just started or is due. Called with `_cond` held."""
+        self._pending_count += 1
+        if self._pending_count == 1:
+            self._pending_since = time.monotonic()
+        elif self._flush_now:
+            return  # The flush thread is already woken up.
+
+        if (kind in self.flush_types or
+                self._pending_count >= self.max_batch_items or
+                self._pending_bytes >= self.max_batch_bytes or
+                self.max_batch_latency <= 0):
+            self._flush_now = True
+            self._cond.notify()
+        elif self._pending_count == 1:
+            self._cond.notify()  # Start the batch's latency timer.
+
+    def _append_block_sample(self, time, payload):
+        """Add a sample to the pending block of its layout, False if a block
+        can't hold it."""
+        layout = sample_layout(payload)
+        if layout is None:
+            return False
+
+        with self._cond:
+            builder = self._blocks.get(layout)
+            if builder is None:
+                builder = self._blocks[layout] = BlockBuilder(
+                    self.session_name, layout)
+                self._pending.append(builder)
+            try:
+                builder.add(time, payload.values())
+            except (TypeError, ValueError):
+                return False
+            self._wake('sample')
+        return True
 
     def activate_session(self):
         # Goes through the '/setup/' channel: the server unpacks setup items,
@@ -531,14 +1679,17 @@ class Logger(threading.Thread):
     # a producer that stops publishing leaves its scene in place, the same way
     # the timeseries and images it already sent stay in the viewer.
 
-    def _setup_action(self, op, **fields):
-        self._append_log({
+    def _setup_item(self, op, **fields):
+        return {
             'type': 'setup',
             'op': op,
             'session': self.session_name,
             'producer': self.producer_id,
             **fields
-        })
+        }
+
+    def _setup_action(self, op, **fields):
+        self._append_log(self._setup_item(op, **fields))
 
     def register_setup(self, obj, silent_error=False):
         """Register 3d scene objects (meshes, point clouds) for this session.
@@ -583,49 +1734,49 @@ class Logger(threading.Thread):
     def layout(self, layout_def):
         self.register_setting('layout', 'layout', layout_def)
 
-    def _log_dict(self, obj, silent_error):
-        # Creating a copy so changing the original object's keys doesn't 
-        # interfer with the loggin.
-        obj = dict(obj)  
-        res = {}
-
-        for key, value in obj.items():
-            val_type = type(value)
+    def compile_schema(self, example_obj, silent_error=False):
+        """Fix the keys and value types of the samples `log` takes to those
+        of `example_obj`.
 
-            if key == 'time':  # HACK: Time is just a value, not an array.
-                res['time'] = value
-                continue
-
-            if key.startswith('_'):
-                continue
+        The conversion of every key is worked out once from the example, so
+        logging a sample does no type dispatch; a sample with other keys or
+        value types raises a ValueError. Nested dicts are logged as 'a/b'
+        fields. Without a compiled schema `log` caches such a plan per key
+        layout and rebuilds it when a value type changes.
+        """
+        if issubclass(type(example_obj), tuple(self.loggable_value_classes)):
+            example_obj = example_obj.to_log_dict()
+        schema = _LogPlan(example_obj, self.loggable_value_classes)
+        schema.convert(example_obj, silent_error)  # Rejects unsupported values.
+        self._schema = schema
 
-            if issubclass(val_type, (float, int, bool, str)):
-                res[key] = value
-            elif issubclass(val_type, np.generic):
-                res[key] = float(value)
-            elif issubclass(val_type, np.ndarray) and value.ndim == 1:
-                res[key] = value.copy()
-            # elif issubclass(val_type, dict):
-            #     for dk, dv in value.items():
-            #         if dk.startswith('_') or dk.endswith('_'):
-            #             continue
-            #         self.log(dk, dv, prefix=f"{key}/")
-            elif issubclass(val_type,  tuple(self.loggable_value_classes)):
-                res[key] = value.to_log_dict(key)
-            elif issubclass(val_type, list):
-                if len(value) > 0 and not np.isscalar(value[0]):
-                    continue
-                res[key] = np.array(value, np.float32).copy()
-            elif not silent_error:
-                raise ValueError(f"Asked to log unsupported value ({str(value)}) for path '{key}'.")
+    def _log_dict(self, obj, silent_error):
+        keys = tuple(obj)
+        plan = self._log_plans.get(keys)
+        if plan is not None:
+            try:
+                return plan.convert(obj, silent_error)
+            except _LogPlanMismatch:
+                pass  # A value type changed, replan.
 
-        return res
+        if len(self._log_plans) >= _MAX_LOG_PLANS:
+            self._log_plans.clear()
+        plan = self._log_plans[keys] = _LogPlan(obj, self.loggable_value_classes)
+        return plan.convert(obj, silent_error)
 
     def log(self, obj, time, silent_error=False):
         if issubclass(type(obj), tuple(self.loggable_value_classes)):
             obj = obj.to_log_dict()
 
-        res = self._log_dict(obj, silent_error)
+        if self._schema is not None:
+            res = self._schema.convert(obj, silent_error)
+        else:
+            res = self._log_dict(obj, silent_error)
+
+        if self.sample_blocks and isinstance(time, (float, int)) and \
+                not isinstance(time, bool) and \
+                self._append_block_sample(time, res):
+            return
 
         self._append_log({
             'type': 'sample',
@@ -634,6 +1785,12 @@ class Logger(threading.Thread):
             'payload': res
         })
 
+    def log_block(self, times, columns):
+        """Log N samples at once: `times` [N] and `columns` mapping every
+        field to an [N] or [N, dim] array, sent as one 'sample_block' item
+        (see `sample_blocks`). Columns of another shape raise a ValueError."""
+        self._append_log(make_block(self.session_name, times, columns, 'raw'))
+
     def log_image(self, name, data, time):
         self._append_log({
             'type': 'image',
@@ -0,0 +1,164 @@
+"""
+Merge recordings by time.
+
+Combines any number of .zst recordings (recorder sections, rotated writer
+segments, recordings of different producers) into one indexed recording with
+all entries in time order. The inputs are k-way merged in a single streaming
+pass: only one decoded batch per input is held in memory, however long the
+recordings are.
+
+    python -m mim_data_utils.merge merged.zst recording_*.zst --sessions robot
+"""
+
+import heapq
+import itertools
+import math
+
+from .logger import FileLoggerWriter, FileLoggerReader
+from .recording import item_time, list_segments
+from .schema import is_schema_setup
+
+
+def _input_paths(paths):
+    """The given recordings with the rotated segments of each, in order and
+    without duplicates."""
+    res = []
+    for path in paths:
+        for segment in list_segments(path) or [str(path)]:
+            if segment not in res:
+                res.append(segment)
+    return res
+
+
+def _timed_entries(reader, index, types, sessions):
+    """`(time, input index, seq, entry)` for the entries of one input.
+
+    Entries without a time (setups, commands, static samples) take the time
+    of the entry before them, so they keep their place in the input's order.
+    """
+    t_last = -math.inf
+    seq = itertools.count()
+    for batch in reader.iter_batches(types, sessions):
+        for entry in batch:
+            # Packed samples come out expanded, their schemas are not needed.
+            if is_schema_setup(entry):
+                continue
+            t = item_time(entry)
+            if t is not None:
+                t_last = t
+            yield t_last, index, next(seq), entry
+
+
+class _TimeOrder:
+    """Counts the timed entries passed that are earlier than the timed entry
+    before them, within their stream (type, session and, for samples, field
+    layout) with `per_stream`, or else across all entries."""
+
+    def __init__(self, per_stream):
+        self.per_stream = per_stream
+        self.inversions = 0
+        self._last = {}  # stream -> time of its last timed entry
+
+    def check(self, entry):
+        t = item_time(entry)
+        if t is None:
+            return entry
+
+        stream = None
+        if self.per_stream:
+            stream = (entry.get('type'), entry.get('session'))
+            if stream[0] == 'sample' and isinstance(entry.get('payload'), dict):
+                stream += tuple(entry['payload'])
+        if t < self._last.get(stream, t):
+            self.inversions += 1
+        self._last[stream] = t
+        return entry
+
+
+def merge_recordings(paths, output, types=None, sessions=None, verify=True,
+                     **writer_kwargs):
+    """Merge the recordings at `paths` into one recording at `output`.
+
+    Entries are written in time order; entries with equal times keep the
+    input order. Each input is read in its own order, so an input that is
+    not itself sorted (e.g. images arriving late) stays unsorted locally.
+    `types` / `sessions` keep only the matching entries. `writer_kwargs` are
+    passed on to the `FileLoggerWriter` of the output (e.g.
+    `compression_level`, `sample_encoding`, `max_file_size_mb`).
+
+    With `verify` the output is read back and checked to be in time order
+    where the merged inputs were; a mismatch raises a ValueError. Samples
+    stored as blocks (`sample_encoding`) are only ordered within their
+    stream, so the check is per stream then.
+
+    Returns the number of entries written.
+    """
+    writer_kwargs.setdefault('max_file_size_mb', None)
+    readers = [FileLoggerReader(path, to_numpy=False)
+               for path in _input_paths(paths)]
+    writer = FileLoggerWriter(output, **writer_kwargs)
+    per_stream = writer_kwargs.get('sample_encoding') is not None
+    merged_order = _TimeOrder(per_stream)
+
+    try:
+        merged = heapq.merge(*[
+            _timed_entries(reader, i, types, sessions)
+            for i, reader in enumerate(readers)])
+        count = writer.log_entries(
+            merged_order.check(entry) for _, _, _, entry in merged)
+    finally:
+        writer.close()
+        for reader in readers:
+            reader.close()
+
+    if verify:
+        output_order = _TimeOrder(per_stream)
+        for path in list_segments(output) or [output]:
+            reader = FileLoggerReader(path, to_numpy=False)
+            try:
+                for batch in reader.iter_batches():
+                    for entry in batch:
+                        output_order.check(entry)
+            finally:
+                reader.close()
+        if output_order.inversions != merged_order.inversions:
+            raise ValueError(
+                f'{output} is not in time order: {output_order.inversions} '
+                f'entries are earlier than the one before them, '
+                f'{merged_order.inversions} in the merged inputs.')
+
+    return count
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Merge .zst recordings by time into one indexed recording.')
+    parser.add_argument('output', help='Path of the merged recording')
+    parser.add_argument('inputs', nargs='+',
+                        help='Recordings to merge (rotated segments of each '
+                             'are included)')
+    parser.add_argument('--sessions', nargs='+', default=None,
+                        help='Only keep entries of these sessions')
+    parser.add_argument('--types', nargs='+', default=None,
+                        help="Only keep entries of these types (e.g. 'sample')")
+    parser.add_argument('--compression-level', type=int, default=10,
+                        help='Zstandard compression level 1-22 (default: 10)')
+    parser.add_argument('--sample-encoding', default=None,
+                        choices=['delta', 'xor', 'raw'],
+                        help='Store samples as columnar blocks')
+    parser.add_argument('--no-verify', action='store_true',
+                        help='Skip reading the output back to check its '
+                             'time order')
+    args = parser.parse_args()
+
+    count = merge_recordings(
+        args.inputs, args.output, types=args.types, sessions=args.sessions,
+        compression_level=args.compression_level,
+        sample_encoding=args.sample_encoding, verify=not args.no_verify)
+    print(f'[merge] Wrote {count} entries to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+"""
+Min/max overviews of long recordings.
+
+An overview holds, for every numeric sample field, the min, max, mean, first
+and last value per time bucket at several zoom levels, so plotting the shape
+of a multi-hour recording only reads a few thousand buckets instead of
+millions of samples. It is built in one streaming pass and is itself a
+recording (readable with `FileLoggerReader`): level k is the samples of
+session 'overview:k' (written as sample blocks), with fields '<name>/min',
+'<name>/max', '<name>/mean', '<name>/first', '<name>/last' and 'count', timed
+at the start of their bucket. Its first entry, of type 'overview', lists the
+levels and the source recording.
+
+    overview = Overview.open('run.zst')
+    bucket_s, columns = overview.fetch(t0, t1, width_px=1200)
+"""
+
+import math
+
+import numpy as np
+
+from .columns import ColumnBuilder, file_signature
+from .logger import FileLoggerWriter, FileLoggerReader
+from .sample_blocks import make_block
+
+STATS = ('min', 'max', 'mean', 'first', 'last')
+
+# Samples decoded into columns before they are folded into the buckets.
+_CHUNK_SAMPLES = 65536
+# Buckets per written block, the granularity of reading a time window.
+_BLOCK_BUCKETS = 4096
+
+
+def overview_path(path):
+    """Default path of the overview of a recording."""
+    return str(path) + '.overview'
+
+
+def _nice_bucket(seconds):
+    """The smallest 1, 2 or 5 times a power of ten >= `seconds`."""
+    exponent = math.floor(math.log10(seconds))
+    for mantissa in (1, 2, 5, 10):
+        if mantissa * 10 ** exponent >= seconds:
+            return mantissa * 10. ** exponent
+
+
+class _Buckets:
+    """Per-bucket statistics of all fields, dense from bucket 0 (at `t0`)."""
+
+    def __init__(self, t0, bucket_s):
+        self.t0 = t0
+        self.bucket_s = bucket_s
+        self.n = 0
+        self.capacity = 1024
+        self.samples = np.zeros(self.capacity, np.int64)
+        self.stats = {}  # field -> {'count', 'sum', 'min', ...: [capacity, dim]}
+
+    def _grow(self, needed):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        self.samples = np.concatenate(
+            [self.samples, np.zeros(capacity - self.capacity, np.int64)])
+        for stats in self.stats.values():
+            for key, arr in stats.items():
+                fill = 0 if key in ('count', 'sum') else np.nan
+                pad = np.full((capacity - self.capacity, arr.shape[1]), fill)
+                stats[key] = np.concatenate([arr, pad])
+        self.capacity = capacity
+
+    def _field(self, name, dim):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = {
+                'count': np.zeros((self.capacity, dim)),
+                'sum': np.zeros((self.capacity, dim)),
+                **{key: np.full((self.capacity, dim), np.nan)
+                   for key in ('min', 'max', 'first', 'last')},
+            }
+        return stats
+
+    def add(self, columns):
+        """Fold in a `ColumnBuilder` result (assumed in time order)."""
+        time = columns['time']
+        if not len(time):
+            return
+
+        ids = np.maximum(
+            np.floor((time - self.t0) / self.bucket_s).astype(np.int64), 0)
+        # Runs of samples in the same bucket.
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        ends = np.r_[starts[1:], len(ids)]
+        run_ids = ids[starts]
+
+        if run_ids.max() >= self.capacity:
+            self._grow(run_ids.max() + 1)
+        self.n = max(self.n, run_ids.max() + 1)
+        was_empty = self.samples[run_ids] == 0
+        np.add.at(self.samples, run_ids, ends - starts)
+
+        for name, values in columns.items():
+            if name == 'time':
+                continue
+            stats = self._field(name, values.shape[1])
+            valid = ~np.isnan(values)
+            np.add.at(stats['count'], run_ids,
+                      np.add.reduceat(valid, starts, axis=0))
+            np.add.at(stats['sum'], run_ids,
+                      np.add.reduceat(np.where(valid, values, 0.), starts, axis=0))
+            np.fmin.at(stats['min'], run_ids,
+                       np.fmin.reduceat(values, starts, axis=0))
+            np.fmax.at(stats['max'], run_ids,
+                       np.fmax.reduceat(values, starts, axis=0))
+            first = run_ids[was_empty]
+            stats['first'][first] = values[starts[was_empty]]
+            stats['last'][run_ids] = values[ends - 1]
+
+    def coarsen(self, factor):
+        """The statistics over buckets `factor` times wider."""
+        res = _Buckets(self.t0, self.bucket_s * factor)
+        n = -(-self.n // factor)
+        res._grow(n)
+        res.n = n
+
+        pad = n * factor - self.n
+        samples = np.r_[self.samples[:self.n], np.zeros(pad, np.int64)] \
+            .reshape(n, factor)
+        res.samples[:n] = samples.sum(axis=1)
+        filled = samples > 0
+        first = np.argmax(filled, axis=1)
+        last = factor - 1 - np.argmax(filled[:, ::-1], axis=1)
+        rows = np.arange(n)
+
+        for name, stats in self.stats.items():
+            dim = stats['sum'].shape[1]
+            out = res._field(name, dim)
+
+            def grouped(key, fill):
+                arr = stats[key][:self.n]
+                arr = np.concatenate([arr, np.full((pad, dim), fill)])
+                return arr.reshape(n, factor, dim)
+
+            out['count'][:n] = grouped('count', 0).sum(axis=1)
+            out['sum'][:n] = grouped('sum', 0).sum(axis=1)
+            out['min'][:n] = np.fmin.reduce(grouped('min', np.nan), axis=1)
+            out['max'][:n] = np.fmax.reduce(grouped('max', np.nan), axis=1)
+            out['first'][:n] = grouped('first', np.nan)[rows, first]
+            out['last'][:n] = grouped('last', np.nan)[rows, last]
+        return res
+
+    def columns(self):
+        """`(time, columns)` of the non-empty buckets."""
+        ids = np.flatnonzero(self.samples[:self.n])
+        res = {'count': self.samples[ids].astype(np.float64)}
+        for name, stats in self.stats.items():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = stats['sum'][ids] / stats['count'][ids]
+            res[f'{name}/min'] = stats['min'][ids]
+            res[f'{name}/max'] = stats['max'][ids]
+            res[f'{name}/mean'] = mean
+            res[f'{name}/first'] = stats['first'][ids]
+            res[f'{name}/last'] = stats['last'][ids]
+        return self.t0 + ids * self.bucket_s, res
+
+
+def build_overview(path, output=None, session=None, fields=None,
+                   bucket_s=None, factor=4, max_buckets=8192, min_buckets=256):
+    """Write the overview of the recording at `path` (see the module
+    docstring) to `output` (default: '<path>.overview') and return its path.
+
+    Only the samples of `session` (all if None) and the numeric `fields` (all
+    if None) are summarized. The finest level has buckets of `bucket_s`
+    seconds, by default chosen (1, 2 or 5 times a power of ten) so the
+    indexed duration spans at most `max_buckets`, or 1 ms for recordings
+    without an index. Buckets are doubled as needed while streaming, so the
+    finest level never spans more than `max_buckets`; each further level is
+    `factor` times coarser, down to `min_buckets`. Samples are assumed to be
+    in time order within the recording (for 'first' / 'last').
+    """
+    output = output or overview_path(path)
+    reader = FileLoggerReader(path)
+
+    t0 = None
+    frames = [frame for frame in reader.frames or ()
+              if 'sample' in frame['types'] and frame['t_min'] is not None]
+    if frames:
+        t0 = min(frame['t_min'] for frame in frames)
+        duration = max(frame['t_max'] for frame in frames) - t0
+        if bucket_s is None:
+            bucket_s = _nice_bucket(max(duration / max_buckets, 1e-3))
+    bucket_s = bucket_s or 1e-3
+
+    buckets = None
+    try:
+        for columns in reader.iter_columns(fields, session,
+                                           chunk_samples=_CHUNK_SAMPLES):
+            if not len(columns['time']):
+                continue
+            if buckets is None:
+                if t0 is None:
+                    t0 = float(columns['time'][0])
+                buckets = _Buckets(
+                    math.floor(t0 / bucket_s) * bucket_s, bucket_s)
+            # The buckets are dense, bound their number.
+            while (columns['time'].max() - buckets.t0) / buckets.bucket_s \
+                    >= max_buckets:
+                buckets = buckets.coarsen(2)
+            buckets.add(columns)
+    finally:
+        reader.close()
+
+    levels = []
+    while buckets is not None:
+        levels.append(buckets)
+        if buckets.n <= min_buckets:
+            break
+        buckets = buckets.coarsen(factor)
+
+    writer = FileLoggerWriter(output, None)
+    try:
+        writer.log([{
+            'type': 'overview',
+            'source': str(path),
+            'signature': file_signature(path),
+            'session': session,
+            'fields': sorted(fields) if fields is not None else None,
+            'levels': [
+                {'session': f'overview:{k}', 'bucket_s': level.bucket_s,
+                 'buckets': int(np.count_nonzero(level.samples[:level.n]))}
+                for k, level in enumerate(levels)
+            ],
+        }])
+        for k, level in enumerate(levels):
+            time, columns = level.columns()
+            for i in range(0, len(time), _BLOCK_BUCKETS):
+                rows = slice(i, i + _BLOCK_BUCKETS)
+                writer.log([make_block(
+                    f'overview:{k}', time[rows],
+                    {name: col[rows] for name, col in columns.items()})])
+            # One level per frame (at least), so reading a level skips the
+            # frames of the others.
+            writer.flush()
+    finally:
+        writer.close()
+
+    return output
+
+
+class Overview:
+    """Reads an overview written by `build_overview`."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.reader = FileLoggerReader(self.path, to_numpy=False)
+        self.info = self.reader.next()
+        if self.info is None or self.info.get('type') != 'overview':
+            raise ValueError(f'{self.path} is not a recording overview.')
+        self.levels = self.info['levels']
+
+    @classmethod
+    def open(cls, recording_path, path=None, **build_kwargs):
+        """The overview of a recording, (re)built first if it is missing or
+        older than the recording."""
+        path = path or overview_path(recording_path)
+        try:
+            overview = cls(path)
+            if overview.info['signature'] == file_signature(recording_path):
+                return overview
+            overview.close()
+        except (OSError, ValueError):
+            pass
+
+        return cls(build_overview(recording_path, path, **build_kwargs))
+
+    def level_for(self, t0, t1, width_px):
+        """Index of the coarsest level with at least one bucket per pixel for
+        the window, None if even the finest one is too coarse."""
+        best = None
+        for k, level in enumerate(self.levels):
+            if (t1 - t0) / level['bucket_s'] >= width_px:
+                best = k
+        return best
+
+    def fetch(self, t0, t1, width_px, fields=None):
+        """`(bucket_s, columns)` to plot `fields` (all if None) over the window
+        [t0, t1] on `width_px` pixels.
+
+        The columns are those of the level chosen by `level_for` (see the
+        module docstring). When the window is narrower than the finest level
+        resolves, the raw samples are read from the source recording instead
+        and returned with `bucket_s` 0 and the plain field names.
+        """
+        k = self.level_for(t0, t1, width_px)
+        if k is None:
+            return 0., self._fetch_raw(t0, t1, fields)
+
+        level = self.levels[k]
+        wanted = None
+        if fields is not None:
+            wanted = {'count'} | {f'{field}/{stat}'
+                                  for field in fields for stat in STATS}
+        # The bucket holding t0 starts up to a bucket width before it.
+        start = t0 - level['bucket_s']
+        columns = next(self.reader.iter_columns(
+            wanted, level['session'], start, t1))
+        # Blocks overlapping the window may hold buckets outside of it.
+        keep = (columns['time'] >= start) & (columns['time'] <= t1)
+        return level['bucket_s'], {key: col[keep] for key, col in columns.items()}
+
+    def _fetch_raw(self, t0, t1, fields):
+        session = self.info['session']
+        reader = FileLoggerReader(self.info['source'], to_numpy=False)
+        try:
+            builder = ColumnBuilder(fields)
+            for entry in reader.read_range(
+                    t0, t1, types=['sample'],
+                    sessions=[session] if session is not None else None):
+                builder.add_entry(entry)
+            return builder.finish()
+        finally:
+            reader.close()
+
+    def close(self):
+        self.reader.close()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Write the min/max overview of a .zst recording.')
+    parser.add_argument('path', help='Path of the recording')
+    parser.add_argument('-o', '--output', default=None,
+                        help="Path of the overview (default: '<path>.overview')")
+    parser.add_argument('--session', default=None,
+                        help='Only summarize the samples of this session')
+    parser.add_argument('--fields', nargs='+', default=None,
+                        help='Only summarize these fields')
+    parser.add_argument('--bucket-s', type=float, default=None,
+                        help='Bucket width of the finest level in seconds '
+                             '(default: from the recording duration)')
+    parser.add_argument('--factor', type=int, default=4,
+                        help='Bucket width ratio between levels (default: 4)')
+    args = parser.parse_args()
+
+    output = build_overview(args.path, args.output, session=args.session,
+                            fields=args.fields, bucket_s=args.bucket_s,
+                            factor=args.factor)
+    overview = Overview(output)
+    for level in overview.levels:
+        print(f"[overview] {level['session']}: {level['buckets']} buckets of "
+              f"{level['bucket_s']:g} s")
+    overview.close()
+    print(f'[overview] Wrote {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,6 @@ file.  The file format is identical to FileLoggerWriter so recordings can be
 read back with FileLoggerReader.
 """
 
-import struct
 import subprocess
 import threading
 import time
@@ -15,11 +14,18 @@ from datetime import datetime
 from pathlib import Path
 
 import ormsgpack
-import zstandard
 import websocket
 
+try:
+    from .recording import (  # package import
+        RecordingWriter, BlobWriter, blob_path, HEAVY_TYPES)
+except ImportError:
+    from recording import (   # run-as-script
+        RecordingWriter, BlobWriter, blob_path, HEAVY_TYPES)
+
 _VIDEO_TYPES = {b'image', b'video_segment', 'image', 'video_segment'}
-_TIMESERIES_TYPES = {b'sample', b'depth', 'sample', 'depth'}
+_TIMESERIES_TYPES = {b'sample', b'packed_samples', b'sample_block', b'depth',
+                     'sample', 'packed_samples', 'sample_block', 'depth'}
 
 # Frames buffered per camera before fps is estimated and ffmpeg is launched.
 _FPS_ESTIMATE_FRAMES = 15
@@ -220,11 +226,15 @@ class Recorder:
     :meth:`start_recording` / :meth:`stop_recording`.
 
     The output file is readable with ``FileLoggerReader``.
+
+    With ``blob_store`` the JPEG / depth data of embedded camera and depth
+    items is written to a companion ``<path>.blobs`` file instead of being
+    compressed again with the rest of the stream.
     """
 
     def __init__(self, path, max_file_size_mb, host='127.0.0.1', port=5678,
                  compression_level=10, embed_video=False, encode_video=False,
-                 with_timeseries=True):
+                 with_timeseries=True, blob_store=False):
         self.path = str(path)
         self.url = f'ws://{host}:{port}/'
         self._host = host
@@ -234,12 +244,14 @@ class Recorder:
         self.embed_video = embed_video
         self.encode_video = encode_video
         self.with_timeseries = with_timeseries
+        self.blob_store = blob_store
 
         self._ws = None
         self._ws_thread = None
         self._lock = threading.Lock()
         self._fh = None
-        self._compressor = None
+        self._writer = None
+        self._blobs = None
         self._connected = False
         self._recording = False
         self._bytes_written = 0
@@ -252,25 +264,39 @@ class Recorder:
 
     def _open_file(self):
         self._fh = open(self.path, 'wb')
-        cctx = zstandard.ZstdCompressor(level=self.compression_level)
-        self._compressor = cctx.stream_writer(self._fh)
+        self._writer = RecordingWriter(self._fh, self.compression_level)
+        if self.blob_store:
+            self._blobs = BlobWriter(open(blob_path(self.path), 'wb'))
         self._bytes_written = 0
         self._messages_written = 0
 
-    def _write(self, data: bytes):
-        """Write one websocket message (raw msgpack bytes) to the file."""
-        header = struct.pack('>I', len(data))
+    def _write(self, data: bytes, items=None):
+        """Write one websocket message (raw msgpack bytes) to the file.
+
+        `items` is the unpacked message if at hand; it fills the frame index
+        (time span, types, sessions). Raw writes leave those frames unknown.
+        """
         with self._lock:
-            if self._compressor is None:
+            if self._writer is None:
                 return
 
-            self._compressor.write(header)
-            self._compressor.write(data)
-            self._bytes_written += len(header) + len(data)
+            if self._blobs is not None and items is not None and any(
+                    isinstance(i, dict) and i.get('type') in HEAVY_TYPES
+                    for i in items):
+                items = [self._blobs.externalize(i)
+                         if isinstance(i, dict) and i.get('type') in HEAVY_TYPES
+                         else i for i in items]
+                self._blobs.flush()
+                data = ormsgpack.packb(items)
+
+            self._writer.write(data, items)
+            self._bytes_written += 4 + len(data)
             self._messages_written += 1
 
             if self._messages_written % 100 == 0:
                 disk_size = Path(self.path).stat().st_size / (1024 * 1024)
+                if self._blobs is not None:
+                    disk_size += self._blobs.bytes_written / (1024 * 1024)
                 if disk_size > self.max_file_size_mb:
                     print(f'[recorder] File size limit reached '
                           f'({disk_size:.1f} MB), stopping recording.')
@@ -278,10 +304,12 @@ class Recorder:
 
     def _close_file(self):
         with self._lock:
-            if self._compressor is not None:
-                self._compressor.flush(zstandard.FLUSH_FRAME)
-                self._compressor.close()
-                self._compressor = None
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if self._blobs is not None:
+                self._blobs.fh.close()
+                self._blobs = None
             if self._fh is not None:
                 self._fh.close()
                 self._fh = None
@@ -314,7 +342,7 @@ class Recorder:
 
         # Nothing to filter and nothing to encode -> write raw bytes, no unpack.
         no_filter = self.embed_video and self.with_timeseries
-        if no_filter and not self.encode_video:
+        if no_filter and not self.encode_video and not self.blob_store:
             self._write(message)
             return
 
@@ -333,13 +361,13 @@ class Recorder:
                         _item_field(i, 'time'))
 
         if no_filter:
-            self._write(message)
+            self._write(message, items)
             return
 
         items = [i for i in items if self._keep(i)]
         if not items:
             return
-        self._write(ormsgpack.packb(items))
+        self._write(ormsgpack.packb(items), items)
 
     def _feed_encoder(self, name, jpeg, t):
         if name is None or jpeg is None:
@@ -485,6 +513,9 @@ def main():
     parser.add_argument('--without-timeseries', action='store_true', default=False,
                         help='Do not log timeseries (sample/depth) data to the '
                              'recording (logged by default)')
+    parser.add_argument('--blob-store', action='store_true', default=False,
+                        help='Store image/depth data uncompressed in a '
+                             'companion .blobs file instead of inline')
     args = parser.parse_args()
 
     # The path is a template filled per recording section (see _fill_template):
@@ -502,6 +533,7 @@ def main():
         embed_video=args.with_embed_video,
         encode_video=args.with_encode_video,
         with_timeseries=not args.without_timeseries,
+        blob_store=args.blob_store,
     )
 
     rec.connect()
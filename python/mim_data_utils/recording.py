@@ -0,0 +1,911 @@
+"""
+Container format of the .zst recordings written by FileLoggerWriter.
+
+A recording is a sequence of records: a '>I' length followed by a msgpack
+packed list of items. Older files hold all records in one endless zstd frame,
+so they can only be decoded from byte 0. Recordings written now close an
+independent zstd frame every few MB / seconds and end with a trailing index
+listing, per frame, its byte offset and size together with the time span,
+item types and sessions it holds, and what the whole recording holds (item
+counts and bytes per type, sample fields, markers; see `RecordingStats`). A
+reader can then decode just the frames it needs, or summarize the recording
+without decoding any.
+
+The index lives in a zstd skippable frame, so `zstd -d` and readers that don't
+know about it still decompress the file as before. Its last 16 bytes are a
+fixed footer (index length + magic), so it can be found from the end of the
+file without scanning. Files without an index are read by a linear scan.
+
+Recordings may start with a header, another skippable frame, holding a zstd
+dictionary that all data frames are compressed with. Small batches full of
+the same key strings compress much better with one.
+
+Each record may be preceded by a small envelope summarizing its batch (same
+fields as a frame's index entry). It is flagged by the top bit of the first
+length word: `>I (flag | envelope length)`, envelope, `>I payload length`,
+payload. Readers filtering by time, type or session skip the msgpack decode
+of every batch the envelope rules out.
+
+Large binary fields of camera and depth items (JPEG images, raw depth) can be
+kept out of the zstd stream: they are appended to a companion blob file,
+'<recording>.blobs', as is (already compressed data) or zstd compressed on
+their own (raw depth), and the item holds `{'$blob': [offset, length,
+codec]}` in their place. Readers resolve the references when they return the
+item.
+"""
+
+import mmap
+import re
+import struct
+import time
+from pathlib import Path
+
+import ormsgpack
+import zstandard
+
+# Any magic in 0x184D2A50..0x184D2A5F marks a zstd skippable frame.
+_SKIPPABLE_MAGIC = 0x184D2A5E
+_SKIPPABLE_HEADER = struct.Struct('<II')  # magic, content size
+
+_INDEX_MAGIC = b'MIMIDX01'
+_INDEX_FOOTER = struct.Struct('<Q8s')  # index length, magic
+
+_HEADER_MAGIC = b'MIMHDR01'
+_HEADER_FRAME_MAGIC = 0x184D2A5D  # Distinct from the index frame's.
+
+# Default size of trained dictionaries (zstd's own default).
+DICT_SIZE = 112640
+
+INDEX_VERSION = 1
+
+_RECORD_HEADER = struct.Struct('>I')
+_ENVELOPE_FLAG = 0x80000000
+# Envelopes are packed as a plain array in this order to keep them small.
+_ENVELOPE_FIELDS = ('items', 't_min', 't_max', 'types', 'sessions')
+
+_BLOB_KEY = '$blob'
+# Binary fields smaller than this stay inline.
+BLOB_MIN_BYTES = 16 * 1024
+# Fields holding raw data that is worth compressing in the blob file; anything
+# else (JPEG, video) is stored as is.
+_COMPRESSIBLE_BLOB_FIELDS = {('depth', 'depth')}
+
+
+def item_time(item):
+    """The numeric time of an item, None if it has none (e.g. 'static')."""
+    t = item.get('time')
+    if isinstance(t, (int, float)) and not isinstance(t, bool):
+        return float(t)
+    return None
+
+
+def summarize(items):
+    """Item count, time span, types and sessions of a batch (its envelope)."""
+    t_min = t_max = None
+    types = set()
+    sessions = set()
+    count = 0
+
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+
+        sessions.add(item.get('session'))
+        # Blocks and packed samples are indexed as the samples they expand to.
+        if item.get('type') == 'sample_block':
+            count += item['n']
+            types.add('sample')
+            span = (item['t_min'], item['t_max']) if item['n'] else ()
+        elif item.get('type') == 'packed_samples':
+            count += len(item['rows'])
+            types.add('sample')
+            span = [row[0] for row in item['rows']]
+        else:
+            count += 1
+            types.add(item.get('type'))
+            t = item_time(item)
+            span = (t,) if t is not None else ()
+
+        for t in span:
+            if t_min is None or t < t_min:
+                t_min = t
+            if t_max is None or t > t_max:
+                t_max = t
+
+    return {
+        'items': count,
+        't_min': t_min,
+        't_max': t_max,
+        'types': sorted(t for t in types if t is not None),
+        'sessions': sorted(s for s in sessions if s is not None),
+    }
+
+
+class FrameStats:
+    """Summary of the items written into one zstd frame (an index entry)."""
+
+    def __init__(self):
+        self.t_min = None
+        self.t_max = None
+        self.types = set()
+        self.sessions = set()
+        self.items = 0
+        self.records = 0
+        self.raw_size = 0
+
+    def add(self, summary, raw_size):
+        self.records += 1
+        self.raw_size += raw_size
+
+        if summary is None:
+            return
+
+        self.items += summary['items']
+        self.types.update(summary['types'])
+        self.sessions.update(summary['sessions'])
+
+        if summary['t_min'] is None:
+            return
+        if self.t_min is None or summary['t_min'] < self.t_min:
+            self.t_min = summary['t_min']
+        if self.t_max is None or summary['t_max'] > self.t_max:
+            self.t_max = summary['t_max']
+
+    def to_dict(self, offset, size):
+        return {
+            'offset': offset,
+            'size': size,
+            'raw_size': self.raw_size,
+            'records': self.records,
+            'items': self.items,
+            't_min': self.t_min,
+            't_max': self.t_max,
+            'types': sorted(self.types),
+            'sessions': sorted(self.sessions),
+        }
+
+
+# Camera items: video frames and depth frames, the large binary items. Their
+# 'name' is the camera they come from. Writers keep them out of the records
+# (and in the blob file) of the other items.
+HEAVY_TYPES = ('image', 'video_segment', 'depth')
+
+
+def _binary_size(item):
+    """Bytes of the binary fields of an item, inline or in the blob file."""
+    kind = item.get('type')
+    if kind == 'sample':
+        return 0
+    if kind == 'sample_block':
+        return len(item['time']) + sum(len(data) for _, _, data in item['fields'])
+    if kind == 'packed_samples':
+        # Each row also packs its time as a float64.
+        return sum(9 + len(values) for _, values in item['rows'])
+
+    size = 0
+    for value in item.values():
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            size += len(value)
+        elif is_blob_ref(value):
+            size += value[_BLOB_KEY][1]
+    return size
+
+
+def _field_dim(value):
+    """0 for a number, the length of a list / array, None for anything else."""
+    if isinstance(value, (float, int)):
+        return 0
+    if isinstance(value, (list, tuple)):
+        return len(value)
+    ndim = getattr(value, 'ndim', None)  # numpy arrays and scalars
+    if ndim == 0:
+        return 0
+    if ndim == 1:
+        return len(value)
+    return None
+
+
+class RecordingStats:
+    """What a whole recording holds beyond its frame index: item count and
+    bytes per type and per camera, the sample fields of every session and
+    the markers. The writer stores it in the index ('stats').
+
+    Bytes are uncompressed: binary data (images, depth, also when moved to
+    the blob file, and the columns of sample blocks) count exactly, the rest
+    of a record is shared evenly among its items. `schemas` maps schema ids to payloads, for the fields
+    of packed samples.
+    """
+
+    def __init__(self, schemas=None):
+        self.schemas = schemas if schemas is not None else {}
+        self.types = {}    # type -> [items, bytes]
+        self.cameras = {}  # name -> [items, bytes]
+        self.fields = {}   # (session, name) -> dim (0: scalar, None: not numeric)
+        self.markers = []
+        self._layouts = set()
+
+    def _add_fields(self, session, layout, dims):
+        if (session, layout) in self._layouts:
+            return
+        self._layouts.add((session, layout))
+        for name, dim in zip(layout, dims()):
+            self.fields[(session, name)] = dim
+
+    def add(self, items, raw_size):
+        items = [item for item in items if isinstance(item, dict)]
+        if not items:
+            return
+
+        sizes = [_binary_size(item) for item in items]
+        share = max(raw_size - sum(sizes), 0) / len(items)
+
+        for item, size in zip(items, sizes):
+            kind = item.get('type')
+            session = item.get('session')
+            count = 1
+            if kind == 'sample':
+                payload = item.get('payload')
+                if isinstance(payload, dict):
+                    self._add_fields(session, tuple(payload), lambda: [
+                        _field_dim(value) for value in payload.values()])
+            elif kind == 'sample_block':
+                kind, count = 'sample', item['n']
+                self._add_fields(
+                    session, tuple(name for name, _, _ in item['fields']),
+                    lambda: [dim for _, dim, _ in item['fields']])
+            elif kind == 'packed_samples':
+                kind, count = 'sample', len(item['rows'])
+                schema = self.schemas.get(item['schema'])
+                if schema is not None:
+                    self._add_fields(
+                        session, tuple(name for name, _, _ in schema['fields']),
+                        lambda: [dim for _, _, dim in schema['fields']])
+            elif kind == 'marker':
+                self.markers.append([item_time(item), item.get('label')])
+
+            stats = self.types.setdefault(kind, [0, 0.])
+            stats[0] += count
+            stats[1] += size + share
+            if kind in HEAVY_TYPES:
+                stats = self.cameras.setdefault(item.get('name'), [0, 0.])
+                stats[0] += 1
+                stats[1] += size + share
+
+    def add_summary(self, summary, raw_size):
+        """Count a record of items of one type from its envelope, without
+        unpacking it. Per-camera figures need the items, so they aren't
+        counted."""
+        kind, = summary['types']
+        stats = self.types.setdefault(kind, [0, 0.])
+        stats[0] += summary['items']
+        stats[1] += raw_size
+
+    def to_dict(self):
+        # Lists rather than maps: types, sessions and names may be None.
+        return {
+            'types': [[kind, items, round(size)]
+                      for kind, (items, size) in self.types.items()],
+            'cameras': [[name, items, round(size)]
+                        for name, (items, size) in self.cameras.items()],
+            'fields': [[session, name, dim]
+                       for (session, name), dim in self.fields.items()],
+            'markers': self.markers,
+        }
+
+
+class RecordingWriter:
+    """Writes records into independent zstd frames plus a trailing index.
+
+    `write` takes one packed record and, optionally, the items it was packed
+    from, which are summarized in the record's envelope and the frame index.
+    Without them the record's time span, types and sessions stay unknown and
+    readers treat it as matching every query.
+
+    A frame is closed once it holds `frame_size_mb` of uncompressed records or
+    has been open for `frame_interval_s` seconds. Smaller frames make seeking
+    cheaper but compress slightly worse.
+
+    `dictionary` (raw bytes) compresses every frame with that zstd dictionary.
+    With `train_dict_batches` > 0 one is instead trained from the first that
+    many records, which are held back (even through `close_frame`) until then,
+    until `close`, or until the first of them is due to be flushed (see
+    below), whichever comes first: training then uses the records at hand,
+    so a crash-tolerant writer trains on its first `flush_interval_s`
+    seconds. If training fails (too little data) the recording is written
+    without. Either way the dictionary is stored in the file header,
+    so readers pick it up on their own.
+
+    `threads` > 0 uses zstd's multi-threaded compression with that many
+    worker threads.
+
+    `schemas` maps the ids of the sample schemas used by the records (see
+    `schema`) to their payloads. Those known when the first record is written
+    go into the file header, all of them into the index, so readers can
+    expand packed samples of any frame. The caller may add to it meanwhile.
+
+    To bound what a crash loses, the compressed data of the open frame is
+    flushed to the file (a zstd block flush, the frame stays open) once
+    `flush_interval_s` seconds or `flush_size_mb` of records passed since
+    the last flush. `flush_block` does it on demand, e.g. from a timer while
+    no new records come in. Readers recover every complete record before a
+    truncated tail.
+    """
+
+    def __init__(self, fh, compression_level=10, frame_size_mb=4.,
+                 frame_interval_s=10., dictionary=None, train_dict_batches=0,
+                 dict_size=DICT_SIZE, threads=0, flush_interval_s=0.25,
+                 flush_size_mb=1., schemas=None):
+        self.fh = fh
+        self.schemas = schemas if schemas is not None else {}
+        self.flush_interval_s = flush_interval_s
+        self.flush_size = int(flush_size_mb * 1024 * 1024) if flush_size_mb else None
+        self.compression_level = compression_level
+        self.threads = threads
+        self.frame_size = int(frame_size_mb * 1024 * 1024)
+        self.frame_interval_s = frame_interval_s
+        self.dictionary = dictionary
+        self.dict_size = dict_size
+        self.cctx = None
+
+        self.frames = []
+        self.stats = RecordingStats(self.schemas)
+        self.bytes_written = 0  # Compressed bytes, including header and index.
+
+        self._cobj = None
+        self._frame_offset = 0
+        self._frame_stats = None
+        self._frame_opened = 0.
+        self._unflushed = 0
+        self._last_flush = 0.
+
+        self._train_dict_batches = train_dict_batches
+        self._pending = [] if train_dict_batches and not dictionary else None
+        self._pending_since = 0.
+        self._pending_size = 0
+
+    def _start(self):
+        """Write the file header; compression settings are final from here."""
+        dict_data = None
+        if self.dictionary:
+            dict_data = zstandard.ZstdCompressionDict(self.dictionary)
+        self.cctx = zstandard.ZstdCompressor(
+            level=self.compression_level, dict_data=dict_data,
+            threads=self.threads)
+        header = {
+            'version': INDEX_VERSION,
+            'dictionary': self.dictionary,
+        }
+        if self.schemas:
+            header['schemas'] = list(self.schemas.values())
+        self._out(pack_header(header))
+
+    def _finish_training(self):
+        pending, self._pending = self._pending, None
+        self.dictionary = train_dictionary(
+            [payload for payload, _ in pending], self.dict_size)
+        for payload, items in pending:
+            self.write(payload, items)
+
+    def _open_frame(self):
+        if self.cctx is None:
+            self._start()
+        self._cobj = self.cctx.compressobj()
+        self._frame_offset = self.bytes_written
+        self._frame_stats = FrameStats()
+        self._frame_opened = time.monotonic()
+
+    def _out(self, data):
+        if data:
+            self.fh.write(data)
+            self.bytes_written += len(data)
+
+    def write(self, payload, items=None):
+        if self._pending is not None:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.append((bytes(payload), items))
+            self._pending_size += len(payload)
+            if len(self._pending) >= self._train_dict_batches or \
+                    (self.flush_size is not None and
+                     self._pending_size >= self.flush_size) or \
+                    self.flush_due == 0.:
+                self._finish_training()
+            return
+
+        if self._cobj is None:
+            self._open_frame()
+
+        if items is not None:
+            summary = summarize(items)
+            envelope = ormsgpack.packb(
+                [summary[key] for key in _ENVELOPE_FIELDS])
+            header = (_RECORD_HEADER.pack(_ENVELOPE_FLAG | len(envelope)) +
+                      envelope + _RECORD_HEADER.pack(len(payload)))
+        else:
+            summary = None
+            header = _RECORD_HEADER.pack(len(payload))
+
+        self._out(self._cobj.compress(header))
+        self._out(self._cobj.compress(payload))
+        self._frame_stats.add(summary, len(header) + len(payload))
+        if items is not None:
+            self.stats.add(items, len(payload))
+        if not self._unflushed:
+            self._last_flush = time.monotonic()
+        self._unflushed += len(header) + len(payload)
+
+        now = time.monotonic()
+        if (self._frame_stats.raw_size >= self.frame_size or
+                now - self._frame_opened >= self.frame_interval_s):
+            self.close_frame()
+        elif (self.flush_size is not None and self._unflushed >= self.flush_size) or \
+                (self.flush_interval_s is not None and
+                 now - self._last_flush >= self.flush_interval_s):
+            self.flush_block()
+
+    @property
+    def flush_due(self):
+        """Seconds until unflushed records are due to be flushed, None if
+        there are none."""
+        if self.flush_interval_s is None:
+            return None
+        if self._pending:  # Held back for training.
+            since = self._pending_since
+        elif self._unflushed:
+            since = self._last_flush
+        else:
+            return None
+        return max(0., since + self.flush_interval_s - time.monotonic())
+
+    def flush_block(self):
+        """Push all records written so far to the file without ending the
+        frame, so they survive a crash of the process. Ends dictionary
+        training early if records are held back for it."""
+        if self._pending:
+            self._finish_training()
+        if self._cobj is None or not self._unflushed:
+            return
+
+        self._out(self._cobj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+        self.fh.flush()
+        self._unflushed = 0
+
+    def close_frame(self):
+        """End the current zstd frame and record it in the index."""
+        if self._cobj is None:
+            return
+
+        self._out(self._cobj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH))
+        self.fh.flush()
+        self.frames.append(self._frame_stats.to_dict(
+            self._frame_offset, self.bytes_written - self._frame_offset))
+        self._cobj = None
+        self._frame_stats = None
+        self._unflushed = 0
+
+    def close(self):
+        """Close the last frame and append the index. Doesn't close `fh`."""
+        if self._pending is not None:
+            self._finish_training()
+        self.close_frame()
+        if self.cctx is None:
+            self._start()
+        index = {
+            'version': INDEX_VERSION,
+            'frames': self.frames,
+            'stats': self.stats.to_dict(),
+        }
+        if self.schemas:
+            index['schemas'] = list(self.schemas.values())
+        self._out(pack_index(index))
+
+
+def train_dictionary(samples, dict_size=DICT_SIZE):
+    """Train a zstd dictionary (raw bytes) on packed records, None if there
+    is too little data to train on."""
+    # zstd wants roughly 10x more sample data than the dictionary size.
+    dict_size = min(dict_size, sum(len(s) for s in samples) // 10)
+    try:
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+    except zstandard.ZstdError as e:
+        print(f'[recording] Not using a dictionary, training failed: {e}')
+        return None
+
+
+def pack_header(header):
+    """The file header as a zstd skippable frame."""
+    content = _HEADER_MAGIC + ormsgpack.packb(header)
+    return _SKIPPABLE_HEADER.pack(_HEADER_FRAME_MAGIC, len(content)) + content
+
+
+def read_header(fh):
+    """Read the header at the start of a recording, None if it has none.
+
+    Leaves the file position undefined.
+    """
+    fh.seek(0)
+    head = fh.read(_SKIPPABLE_HEADER.size + len(_HEADER_MAGIC))
+    if len(head) < _SKIPPABLE_HEADER.size + len(_HEADER_MAGIC):
+        return None
+
+    magic, content_size = _SKIPPABLE_HEADER.unpack_from(head)
+    if magic != _HEADER_FRAME_MAGIC or \
+            head[_SKIPPABLE_HEADER.size:] != _HEADER_MAGIC:
+        return None
+
+    return ormsgpack.unpackb(fh.read(content_size - len(_HEADER_MAGIC)))
+
+
+def decompressor(header):
+    """A zstd decompressor for the frames of a recording with `header`."""
+    if header and header.get('dictionary'):
+        return zstandard.ZstdDecompressor(
+            dict_data=zstandard.ZstdCompressionDict(header['dictionary']))
+    return zstandard.ZstdDecompressor()
+
+
+def pack_index(index):
+    """The index as a zstd skippable frame ending in the fixed footer."""
+    body = ormsgpack.packb(index)
+    content = body + _INDEX_FOOTER.pack(len(body), _INDEX_MAGIC)
+    return _SKIPPABLE_HEADER.pack(_SKIPPABLE_MAGIC, len(content)) + content
+
+
+def read_index(fh):
+    """Read the trailing index of a recording, None if it has none.
+
+    Leaves the file position undefined.
+    """
+    fh.seek(0, 2)
+    file_size = fh.tell()
+    if file_size < _SKIPPABLE_HEADER.size + _INDEX_FOOTER.size:
+        return None
+
+    fh.seek(file_size - _INDEX_FOOTER.size)
+    body_size, magic = _INDEX_FOOTER.unpack(fh.read(_INDEX_FOOTER.size))
+    if magic != _INDEX_MAGIC:
+        return None
+
+    start = file_size - _INDEX_FOOTER.size - body_size - _SKIPPABLE_HEADER.size
+    if start < 0:
+        return None
+
+    fh.seek(start)
+    skip_magic, content_size = _SKIPPABLE_HEADER.unpack(
+        fh.read(_SKIPPABLE_HEADER.size))
+    if (skip_magic != _SKIPPABLE_MAGIC or
+            content_size != body_size + _INDEX_FOOTER.size):
+        return None
+
+    index = ormsgpack.unpackb(fh.read(body_size))
+    index['data_size'] = start
+    return index
+
+
+def frame_matches(frame, t0=None, t1=None, types=None, sessions=None):
+    """Whether an indexed frame (or a record's envelope) may hold entries
+    matching the query.
+
+    `t0`/`t1` bound the entry time (inclusive, None for open ends), `types`
+    and `sessions` are collections of accepted values (None for any). Frames
+    written without item information always match.
+    """
+    if not frame['items']:
+        return True
+
+    if t0 is not None or t1 is not None:
+        if frame['t_min'] is None:
+            return False
+        if t1 is not None and frame['t_min'] > t1:
+            return False
+        if t0 is not None and frame['t_max'] < t0:
+            return False
+
+    if types is not None and not set(types).intersection(frame['types']):
+        return False
+    if sessions is not None and not set(sessions).intersection(frame['sessions']):
+        return False
+
+    return True
+
+
+def entry_matches(entry, t0=None, t1=None, types=None, sessions=None):
+    """Whether a single entry matches the query, see `frame_matches`."""
+    if types is not None and entry.get('type') not in types:
+        return False
+    if sessions is not None and entry.get('session') not in sessions:
+        return False
+
+    if t0 is not None or t1 is not None:
+        t = item_time(entry)
+        if t is None:
+            return False
+        if t0 is not None and t < t0:
+            return False
+        if t1 is not None and t > t1:
+            return False
+
+    return True
+
+
+def _unpack_envelope(data):
+    return dict(zip(_ENVELOPE_FIELDS, ormsgpack.unpackb(data)))
+
+
+def iter_records(raw):
+    """Yield `(envelope, payload)` for each record of decompressed frame data.
+
+    `payload` is the packed msgpack batch, `envelope` its summary or None for
+    records written without one.
+    """
+    view = memoryview(raw)
+    pos = 0
+    end = len(view)
+    while pos + _RECORD_HEADER.size <= end:
+        size = _RECORD_HEADER.unpack_from(view, pos)[0]
+        pos += _RECORD_HEADER.size
+
+        envelope = None
+        if size & _ENVELOPE_FLAG:
+            size &= ~_ENVELOPE_FLAG
+            envelope = _unpack_envelope(view[pos:pos + size])
+            pos += size
+            size = _RECORD_HEADER.unpack_from(view, pos)[0]
+            pos += _RECORD_HEADER.size
+
+        yield envelope, view[pos:pos + size]
+        pos += size
+
+
+def read_record(stream):
+    """Read the next `(envelope, payload)` from a `FrameStreamReader`, None at
+    the end. A record cut off by a truncated tail counts as the end. See
+    `iter_records`."""
+    header = stream.read(_RECORD_HEADER.size)
+    if len(header) < _RECORD_HEADER.size:
+        return None
+
+    size = _RECORD_HEADER.unpack(header)[0]
+    envelope = None
+    if size & _ENVELOPE_FLAG:
+        size &= ~_ENVELOPE_FLAG
+        data = stream.read(size + _RECORD_HEADER.size)
+        if len(data) < size + _RECORD_HEADER.size:
+            return None
+        envelope = _unpack_envelope(data[:size])
+        size = _RECORD_HEADER.unpack(data[size:])[0]
+
+    payload = stream.read(size)
+    if len(payload) < size:
+        return None
+
+    return envelope, payload
+
+
+class FrameStreamReader:
+    """File-like reader of the decompressed data of consecutive zstd frames.
+
+    Unlike zstandard's `stream_reader`, everything decodable before a
+    truncated or corrupt tail (a writer that crashed) is returned instead of
+    being dropped or raising; `truncated` tells whether the data ended early.
+    Skippable frames (header, index) are passed over.
+    """
+
+    def __init__(self, fh, dctx, chunk_size=128 * 1024):
+        self.fh = fh
+        self.dctx = dctx
+        self.chunk_size = chunk_size
+        self.truncated = False
+        self._dobj = dctx.decompressobj()
+        self._in_frame = False
+        # File offset of the current frame and how much it decompressed to.
+        self._frame_start = 0
+        self._frame_out = 0
+        self._buffer = bytearray()
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        offset = self.fh.tell()
+        data = self.fh.read(self.chunk_size)
+        if not data:
+            self._eof = True
+            self.truncated = self._in_frame
+            return
+
+        while data:
+            if not self._in_frame:
+                self._frame_start = offset
+                self._frame_out = 0
+            try:
+                out = self._dobj.decompress(data)
+            except zstandard.ZstdError:
+                self._recover(offset + len(data))
+                self._eof = True
+                self.truncated = True
+                return
+            self._buffer += out
+            self._frame_out += len(out)
+
+            if self._dobj.eof:
+                unused = self._dobj.unused_data
+                offset += len(data) - len(unused)
+                data = unused
+                self._dobj = self.dctx.decompressobj()
+                self._in_frame = False
+            else:
+                self._in_frame = True
+                data = None
+
+    def _recover(self, end, step=256):
+        """Decompress the frame that failed again from its start up to `end`,
+        `step` bytes at a time, to keep what it holds before the corrupt data:
+        the failed call returned nothing of the chunk it was given."""
+        pos = self.fh.tell()
+        self.fh.seek(self._frame_start)
+        data = self.fh.read(end - self._frame_start)
+        self.fh.seek(pos)
+
+        dobj = self.dctx.decompressobj()
+        out = bytearray()
+        try:
+            for i in range(0, len(data), step):
+                out += dobj.decompress(data[i:i + step])
+        except zstandard.ZstdError:
+            pass
+        self._buffer += out[self._frame_out:]
+
+    def read(self, size):
+        while len(self._buffer) - self._pos < size and not self._eof:
+            self._fill()
+
+        data = bytes(self._buffer[self._pos:self._pos + size])
+        self._pos += len(data)
+
+        # Drop consumed data now and then rather than on every read.
+        if self._pos > 4 * self.chunk_size:
+            del self._buffer[:self._pos]
+            self._pos = 0
+
+        return data
+
+    def close(self):
+        self._buffer = bytearray()
+
+
+def read_frame_bytes(fh, frame, dctx=None):
+    """Decompress a single indexed frame."""
+    fh.seek(frame['offset'])
+    data = fh.read(frame['size'])
+    dctx = dctx or zstandard.ZstdDecompressor()
+    return dctx.decompressobj().decompress(data)
+
+
+def segment_path(path, index):
+    """Path of the `index`-th segment of a rotated recording: `path` itself
+    for the first one, then 'name.0001.zst', 'name.0002.zst', ..."""
+    if index == 0:
+        return str(path)
+    p = Path(path)
+    return str(p.with_name(f'{p.stem}.{index:04d}{p.suffix}'))
+
+
+def numbered_segments(path):
+    """`(index, path)` of the existing segments of a recording, in order."""
+    p = Path(path)
+    pattern = re.compile(
+        re.escape(p.stem) + r'\.(\d{4,})' + re.escape(p.suffix) + '$')
+
+    numbered = [(0, str(p))] if p.exists() else []
+    if p.parent.exists():
+        for candidate in p.parent.iterdir():
+            match = pattern.match(candidate.name)
+            if match:
+                numbered.append((int(match.group(1)), str(candidate)))
+
+    return sorted(numbered)
+
+
+def list_segments(path):
+    """The existing segments of a (possibly rotated) recording, in order."""
+    return [name for _, name in numbered_segments(path)]
+
+
+def blob_path(path):
+    """Path of the companion blob file of a recording (segment)."""
+    return str(path) + '.blobs'
+
+
+def is_blob_ref(value):
+    return isinstance(value, dict) and len(value) == 1 and _BLOB_KEY in value
+
+
+class BlobWriter:
+    """Appends the large binary fields of items to a blob file and replaces
+    them with references (see the module docstring)."""
+
+    def __init__(self, fh, compression_level=3, min_bytes=BLOB_MIN_BYTES):
+        self.fh = fh
+        self.min_bytes = min_bytes
+        self.bytes_written = 0
+        self._cctx = zstandard.ZstdCompressor(level=compression_level)
+
+    def put(self, data, codec='raw'):
+        """Append `data` and return its reference."""
+        if codec == 'zstd':
+            data = self._cctx.compress(data)
+        offset = self.bytes_written
+        self.fh.write(data)
+        self.bytes_written += len(data)
+        return {_BLOB_KEY: [offset, len(data), codec]}
+
+    def externalize(self, item):
+        """A copy of `item` with its large binary fields moved to the blob
+        file, or `item` itself if there are none."""
+        res = None
+        for key, value in item.items():
+            if not isinstance(value, (bytes, bytearray, memoryview)) or \
+                    len(value) < self.min_bytes:
+                continue
+            if res is None:
+                res = dict(item)
+            codec = 'zstd' if (item.get('type'), key) in \
+                _COMPRESSIBLE_BLOB_FIELDS else 'raw'
+            res[key] = self.put(value, codec)
+        return item if res is None else res
+
+    def flush(self):
+        self.fh.flush()
+
+
+class BlobReader:
+    """Resolves blob references against a recording's blob file, which is
+    memory-mapped on first use."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+        self._map = None
+        self._dctx = zstandard.ZstdDecompressor()
+
+    def _open(self):
+        self._fh = open(self.path, 'rb')
+        size = self._fh.seek(0, 2)
+        self._map = mmap.mmap(self._fh.fileno(), size, access=mmap.ACCESS_READ) \
+            if size else b''
+
+    def get(self, ref):
+        """The data of a reference, None if the blob file lacks it (e.g. a
+        writer crashed before flushing it)."""
+        offset, length, codec = ref[_BLOB_KEY]
+        if self._map is None:
+            try:
+                self._open()
+            except FileNotFoundError:
+                print(f'[recording] Blob file {self.path} is missing.')
+                self._map = b''
+
+        if offset + length > len(self._map):
+            return None
+
+        data = self._map[offset:offset + length]
+        if codec == 'zstd':
+            return self._dctx.decompress(data)
+        elif codec != 'raw':
+            raise ValueError(f"Unknown blob codec '{codec}'.")
+        return data
+
+    def resolve(self, item):
+        """`item` with its blob references replaced by their data (in place)."""
+        for key, value in item.items():
+            if is_blob_ref(value):
+                item[key] = self.get(value)
+        return item
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        if self._fh is not None:
+            self._fh.close()
+        self._map = None
+        self._fh = None
@@ -0,0 +1,279 @@
+"""
+Columnar blocks of samples ('sample_block' items).
+
+A block holds the samples of one session that share the same numeric fields
+as one column per field instead of one dict per sample:
+
+    {'type': 'sample_block', 'session': ..., 'encoding': 'delta', 'n': N,
+     't_min': ..., 't_max': ..., 'time': bytes,
+     'fields': [[name, dim, bytes], ...]}
+
+`dim` is 0 for scalar fields and the vector length otherwise. With the 'raw'
+encoding the columns are little-endian float64, so blocks only hold values
+float64 represents exactly: integers come back as floats, and samples with
+integers beyond 2**53 are left as plain samples. The other encodings make the
+smooth signals of a robot log compressible, losslessly, working on the
+float64 bit patterns of each column (stored column-major) as integers:
+times are stored as their delta-of-delta, small integers for a steady rate.
+Values are stored as the delta to the previous sample ('delta'), which for
+smooth or quantized sensor values leaves mostly zero high bytes, or as the
+XOR with it ('xor', Gorilla style). Deltas are zigzag encoded; the zstd stage
+of the recording then squeezes out the zero bytes.
+
+Readers expand blocks back into 'sample' items; `ColumnBuilder` copies them
+into its columns directly.
+"""
+
+import numpy as np
+
+ENCODINGS = ('raw', 'xor', 'delta')
+
+# Largest integer magnitude float64 holds exactly.
+_MAX_EXACT_INT = 2 ** 53
+
+
+def _zigzag(values):
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def _unzigzag(values):
+    return (values >> np.uint64(1)).view(np.int64) ^ \
+        -(values & np.uint64(1)).view(np.int64)
+
+
+def _encode_time(t):
+    bits = t.view(np.int64)
+    delta = np.diff(bits, prepend=np.int64(0))
+    return _zigzag(np.diff(delta, prepend=np.int64(0))).tobytes()
+
+
+def _decode_time(data):
+    dod = _unzigzag(np.frombuffer(data, np.uint64))
+    return np.cumsum(np.cumsum(dod)).view(np.float64)
+
+
+def _encode_values(values, encoding):
+    """Bytes of a [N] or [N, dim] float64 column, see the module docstring."""
+    if encoding == 'raw':
+        return values.astype('<f8', copy=False).tobytes()
+
+    bits = np.ascontiguousarray(values.T).view(np.int64)
+    if encoding == 'delta':
+        return _zigzag(np.diff(bits, axis=-1, prepend=np.int64(0))).tobytes()
+
+    xored = bits.copy()
+    xored[..., 1:] ^= bits[..., :-1]
+    return xored.tobytes()
+
+
+def _decode_values(data, shape, encoding):
+    if encoding == 'raw':
+        return np.frombuffer(data, '<f8').reshape(shape)
+
+    bits = np.frombuffer(data, np.uint64).reshape(shape[::-1])
+    if encoding == 'delta':
+        bits = np.cumsum(_unzigzag(bits), axis=-1)
+    else:
+        bits = np.bitwise_xor.accumulate(bits, axis=-1)
+    return bits.view(np.float64).T
+
+
+def sample_layout(payload):
+    """The `(name, dim)` layout of a sample payload, None if a block can't
+    hold it."""
+    layout = tuple((key, _dim(value)) for key, value in payload.items())
+    if any(dim is None for _, dim in layout):
+        return None
+    return layout
+
+
+def item_layout(item):
+    """The layout of a timed 'sample' item a block can hold, else None."""
+    if not isinstance(item, dict) or item.get('type') != 'sample':
+        return None
+    t = item.get('time')
+    payload = item.get('payload')
+    if not isinstance(t, (float, int)) or isinstance(t, bool) or \
+            not isinstance(payload, dict):
+        return None
+    return sample_layout(payload)
+
+
+def _exact_int(value):
+    """Whether an int survives the float64 columns of a block."""
+    return -_MAX_EXACT_INT <= value <= _MAX_EXACT_INT
+
+
+def _dim(value):
+    """0 for a number, the length for a flat list / array of numbers, None for
+    anything a block can't hold. Integers beyond 2**53, which float64 would
+    round, can't be held."""
+    if isinstance(value, float):
+        return 0
+    if isinstance(value, int) and not isinstance(value, bool):
+        return 0 if _exact_int(value) else None
+    if isinstance(value, np.ndarray):
+        if value.ndim != 1 or not len(value) or value.dtype.kind not in 'fiu':
+            return None
+        if value.dtype.kind != 'f' and value.dtype.itemsize == 8 and \
+                not (_exact_int(int(value.min())) and
+                     _exact_int(int(value.max()))):
+            return None
+        return len(value)
+    # Checking the first element is enough to tell numeric vectors from lists
+    # of strings or objects; anything else fails to convert later.
+    if isinstance(value, list) and value and \
+            isinstance(value[0], (float, int)) and not isinstance(value[0], bool):
+        if not all(_exact_int(v) for v in value if type(v) is int):
+            return None
+        return len(value)
+    return None
+
+
+def make_block(session, time, columns, encoding='delta'):
+    """A block from `time` (float64[N]) and `columns` ({name: [N] for scalar,
+    [N, dim] for vector fields})."""
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown sample block encoding '{encoding}'.")
+
+    time = np.ascontiguousarray(time, np.float64)
+    if time.ndim != 1:
+        raise ValueError(f'Sample block times must be 1d, got shape {time.shape}.')
+    fields = []
+    for name, values in columns.items():
+        values = np.asarray(values)
+        if values.ndim not in (1, 2) or len(values) != len(time):
+            raise ValueError(
+                f"Field '{name}' of shape {values.shape} doesn't match "
+                f"{len(time)} times, expected [N] or [N, dim].")
+        if values.dtype.kind in 'iu' and values.dtype.itemsize == 8 and \
+                len(values) and not (_exact_int(int(values.min())) and
+                                     _exact_int(int(values.max()))):
+            raise ValueError(f"Field '{name}' holds integers beyond 2**53, "
+                             "which a sample block would round.")
+        values = np.ascontiguousarray(values, np.float64)
+        dim = values.shape[1] if values.ndim == 2 else 0
+        fields.append([name, dim, _encode_values(values, encoding)])
+
+    return {
+        'type': 'sample_block',
+        'session': session,
+        'encoding': encoding,
+        'n': len(time),
+        't_min': float(time.min()) if len(time) else None,
+        't_max': float(time.max()) if len(time) else None,
+        'time': _encode_time(time) if encoding != 'raw'
+        else time.astype('<f8', copy=False).tobytes(),
+        'fields': fields,
+    }
+
+
+class BlockBuilder:
+    """Accumulates samples of one session and field `layout` (`(name, dim)`
+    pairs, as `_dim` gives them) into preallocated columns, for a block."""
+
+    def __init__(self, session, layout, capacity=64):
+        self.session = session
+        self.layout = layout
+        self.n = 0
+        self.time = np.empty(capacity, np.float64)
+        self.columns = [np.empty((capacity, dim) if dim else capacity, np.float64)
+                        for _, dim in layout]
+
+    def add(self, t, values):
+        """Append a sample with `values` in layout order."""
+        n = self.n
+        if n == len(self.time):
+            self.time = np.resize(self.time, 2 * n)
+            self.columns = [np.resize(col, (2 * n,) + col.shape[1:])
+                            for col in self.columns]
+        self.time[n] = t
+        for col, value in zip(self.columns, values):
+            col[n] = value
+        self.n = n + 1
+
+    def block(self, encoding='raw'):
+        n = self.n
+        return make_block(
+            self.session, self.time[:n],
+            {name: col[:n] for (name, _), col in zip(self.layout, self.columns)},
+            encoding)
+
+
+def decode_block(block):
+    """The `(time, {name: column})` of a block, see `make_block`."""
+    n = block['n']
+    encoding = block.get('encoding', 'raw')
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown sample block encoding '{encoding}'.")
+
+    if encoding == 'raw':
+        time = np.frombuffer(block['time'], '<f8')
+    else:
+        time = _decode_time(block['time'])
+
+    columns = {}
+    for name, dim, data in block['fields']:
+        shape = (n, dim) if dim else (n,)
+        columns[name] = _decode_values(data, shape, encoding)
+    return time, columns
+
+
+def encode_samples(items, encoding='delta', min_samples=2):
+    """Replace the timed, purely numeric 'sample' items of a batch by blocks,
+    one per session and field layout, placed where the group's first sample
+    was. Blocks already in the batch are re-encoded to `encoding`. Other
+    items, and groups of fewer than `min_samples`, are kept."""
+    groups = {}
+    res = []
+    for item in items:
+        if isinstance(item, dict) and item.get('type') == 'sample_block' and \
+                item.get('encoding', 'raw') != encoding:
+            res.append(make_block(item.get('session'), *decode_block(item),
+                                  encoding))
+            continue
+        layout = item_layout(item)
+        if layout is None:
+            res.append(item)
+            continue
+
+        group = groups.get((item.get('session'), layout))
+        if group is None:
+            group = groups[(item.get('session'), layout)] = []
+            res.append(group)  # Placeholder, replaced below.
+        group.append(item)
+
+    out = []
+    for entry in res:
+        if not isinstance(entry, list):
+            out.append(entry)
+        elif len(entry) < min_samples:
+            out.extend(entry)
+        else:
+            try:
+                time = np.array([item['time'] for item in entry], np.float64)
+                columns = {
+                    key: np.array([item['payload'][key] for item in entry],
+                                  np.float64)
+                    for key in entry[0]['payload']
+                }
+            except (TypeError, ValueError):
+                out.extend(entry)
+                continue
+            out.append(make_block(
+                entry[0].get('session'), time, columns, encoding))
+    return out
+
+
+def expand_block(block):
+    """The 'sample' items of a block."""
+    time, columns = decode_block(block)
+    session = block.get('session')
+    names = list(columns)
+    values = [columns[name].tolist() for name in names]
+    return [
+        {'type': 'sample', 'time': t, 'session': session,
+         'payload': dict(zip(names, row))}
+        for t, row in zip(time.tolist(), zip(*values))
+    ]
+
@@ -0,0 +1,283 @@
+"""
+Per-sink sampling of logged samples.
+
+A controller logging at 1 kHz wants every sample on disk, while a viewer
+can't show more than its frame rate. A `SamplingPolicy` thins out the samples
+of a batch for one sink (see the `sampling` and `sinks` options of `Logger`),
+per field: every field whose name matches a pattern gets that pattern's rule,
+the first matching pattern winning, and other fields are kept at full rate.
+
+    SamplingPolicy({'*': Decimate(1 / 60), 'contact/*': MinMax(1 / 60)})
+
+Rules are `EveryNth(n)`, `Decimate(interval_s)` and `MinMax(interval_s)`.
+The fields of a sample layout matching the same pattern share one rule
+instance, so a rule decides once per sample for all of them, and once per
+block for the columns of a sample block, which are sliced rather than
+expanded into samples. Only timed samples are thinned: setups, images,
+commands and static samples pass through unchanged.
+"""
+
+import copy
+from fnmatch import fnmatchcase
+
+import numpy as np
+
+from .sample_blocks import decode_block, make_block
+
+# Sample layouts a policy keeps rule state for.
+_MAX_LAYOUTS = 256
+
+
+class EveryNth:
+    """Keep every `n`th sample, starting with the first."""
+
+    def __init__(self, n):
+        if n < 1:
+            raise ValueError(f'EveryNth needs n >= 1, got {n}.')
+        self.n = int(n)
+        self._count = 0
+
+    def keep(self, t):
+        keep = self._count == 0
+        self._count = (self._count + 1) % self.n
+        return keep
+
+    def select(self, times):
+        """Indices of the kept rows of a block."""
+        res = np.arange(-self._count % self.n, len(times), self.n)
+        self._count = (self._count + len(times)) % self.n
+        return res
+
+
+class Decimate:
+    """Keep a sample if at least `interval_s` seconds passed since the last
+    one kept."""
+
+    def __init__(self, interval_s):
+        self.interval_s = interval_s
+        self._last = None
+
+    def keep(self, t):
+        if self._last is not None and t - self._last < self.interval_s:
+            return False
+        self._last = t
+        return True
+
+    def select(self, times):
+        """Indices of the kept rows of a block."""
+        if len(times) > 1 and np.any(np.diff(times) < 0):
+            return np.flatnonzero([self.keep(t) for t in times.tolist()])
+
+        res = []
+        i = 0 if self._last is None else \
+            _first_after(times, self._last, self.interval_s)
+        while i < len(times):
+            res.append(i)
+            self._last = float(times[i])
+            i = _first_after(times, self._last, self.interval_s)
+        return np.array(res, np.intp)
+
+
+class MinMax:
+    """Keep the envelope of the fields per `interval_s` seconds: their minimum
+    at the time of the interval's first sample and their maximum at the time
+    of its last one (elementwise for vectors), so peaks survive the
+    decimation. An interval holding a single sample is kept as it is.
+
+    An interval is sent once a sample of the next one arrives. Only numeric
+    fields get this rule; others matching its pattern are kept at full rate.
+    """
+
+    def __init__(self, interval_s):
+        self.interval_s = interval_s
+        self._start = None   # Time of the open interval's first sample.
+        self._last = None    # and of its last one.
+        self._first = None   # Values of its first sample.
+        self._rows = []      # Values of its samples not yet reduced.
+        self._min = self._max = None  # Reduced columns, or None.
+
+    def add(self, t, values):
+        """Add a sample (`values` in field order), return the emitted
+        `(time, values)` of a closed interval."""
+        res = []
+        if self._start is not None and t - self._start >= self.interval_s:
+            res = self._close()
+        if self._start is None:
+            self._start = t
+            self._first = values
+        self._rows.append(values)
+        self._last = t
+        return res
+
+    def add_rows(self, times, columns):
+        """Add the rows of a block (`columns` in field order), return the
+        emitted `(time, values)` of the closed intervals."""
+        if len(times) > 1 and np.any(np.diff(times) < 0):
+            return [emitted for i, t in enumerate(times.tolist())
+                    for emitted in self.add(t, [col[i] for col in columns])]
+
+        res = []
+        i, n = 0, len(times)
+        while i < n:
+            end = i
+            if self._start is None:
+                self._start = float(times[i])
+                self._first = [col[i] for col in columns]
+                end = i + 1
+            end = max(end, _first_after(times, self._start, self.interval_s))
+            if end > i:
+                self._reduce([col[i:end] for col in columns])
+                self._last = float(times[end - 1])
+            if end < n:
+                res += self._close()
+            i = end
+        return res
+
+    def _reduce(self, columns):
+        lo = [col.min(axis=0) for col in columns]
+        hi = [col.max(axis=0) for col in columns]
+        if self._min is not None:
+            lo = [np.minimum(a, b) for a, b in zip(self._min, lo)]
+            hi = [np.maximum(a, b) for a, b in zip(self._max, hi)]
+        self._min, self._max = lo, hi
+
+    def _close(self):
+        if self._rows:
+            self._reduce([np.array(col, np.float64) for col in zip(*self._rows)])
+        start, first = self._start, self._first
+        lo, hi = self._min, self._max
+        self._start = self._first = self._min = self._max = None
+        self._rows = []
+
+        if start == self._last:
+            return [(start, first)]  # A single sample.
+        return [(start, [v.item() if v.ndim == 0 else v for v in lo]),
+                (self._last, [v.item() if v.ndim == 0 else v for v in hi])]
+
+
+class SamplingPolicy:
+    """Thins out the samples of outgoing batches, see the module docstring.
+
+    `rules` maps field name patterns (`fnmatch` style, e.g. 'imu/*') to
+    rules. A policy keeps the state of its rules between batches, so each
+    sink needs its own.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules.items())
+        # (session, field names) -> (full rate names, [(rule, names)])
+        self._plans = {}
+
+    def _plan(self, session, payload):
+        key = (session, tuple(payload))
+        plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+
+        full = []
+        groups = {}  # pattern index -> names
+        for name, value in payload.items():
+            index = None
+            if name != 'time':
+                index = next((i for i, (pattern, _) in enumerate(self.rules)
+                              if fnmatchcase(name, pattern)), None)
+            if index is not None and isinstance(self.rules[index][1], MinMax) \
+                    and not _is_numeric(value):
+                index = None
+            if index is None:
+                full.append(name)
+            else:
+                groups.setdefault(index, []).append(name)
+
+        if len(self._plans) >= _MAX_LAYOUTS:
+            self._plans.clear()
+        plan = self._plans[key] = (full, [
+            (copy.copy(self.rules[index][1]), names)
+            for index, names in groups.items()])
+        return plan
+
+    def _sample(self, item, res):
+        t = item.get('time')
+        payload = item.get('payload')
+        if not isinstance(t, (float, int)) or isinstance(t, bool) or \
+                not isinstance(payload, dict):
+            res.append(item)
+            return
+
+        session = item.get('session')
+        full, groups = self._plan(session, payload)
+        kept = {name: payload[name] for name in full}
+        earlier = {}  # time -> payload, of values sent late (MinMax)
+        for rule, names in groups:
+            if not isinstance(rule, MinMax):
+                if rule.keep(t):
+                    kept.update((name, payload[name]) for name in names)
+                continue
+            for t_value, values in rule.add(t, [payload[name] for name in names]):
+                target = kept if t_value == t else earlier.setdefault(t_value, {})
+                target.update(zip(names, values))
+
+        for t_value in sorted(earlier):
+            res.append({'type': 'sample', 'time': t_value, 'session': session,
+                        'payload': earlier[t_value]})
+        if any(name != 'time' for name in kept):
+            res.append(dict(item, payload=kept))
+
+    def _block(self, block, res):
+        session = block.get('session')
+        times, columns = decode_block(block)
+        full, groups = self._plan(session, columns)
+
+        def add(times, names, rows=None):
+            if len(times):
+                res.append(make_block(session, times, {
+                    name: columns[name] if rows is None else columns[name][rows]
+                    for name in names}, 'raw'))
+
+        if full:
+            res.append(block)
+            if groups:  # Only the full rate fields.
+                res[-1] = dict(block, fields=[
+                    field for field in block['fields'] if field[0] in full])
+        for rule, names in groups:
+            if not isinstance(rule, MinMax):
+                rows = rule.select(times)
+                add(times[rows], names, rows)
+                continue
+            emitted = rule.add_rows(times, [columns[name] for name in names])
+            if emitted:
+                values = list(zip(*[row for _, row in emitted]))
+                res.append(make_block(session, [t for t, _ in emitted], {
+                    name: np.array(col, np.float64)
+                    for name, col in zip(names, values)}, 'raw'))
+
+    def apply(self, items):
+        """The items of a batch with their samples thinned out."""
+        res = []
+        for item in items:
+            kind = item.get('type')
+            if kind == 'sample':
+                self._sample(item, res)
+            elif kind == 'sample_block':
+                self._block(item, res)
+            else:
+                res.append(item)
+        return res
+
+
+def _first_after(times, start, interval):
+    """The index of the first of the sorted `times` with
+    `t - start >= interval`, compared like single samples are."""
+    i = int(np.searchsorted(times, start + interval))
+    while i > 0 and times[i - 1] - start >= interval:
+        i -= 1
+    while i < len(times) and times[i] - start < interval:
+        i += 1
+    return i
+
+
+def _is_numeric(value):
+    if isinstance(value, (float, int, np.ndarray, list)) and \
+            not isinstance(value, bool):
+        return not isinstance(value, np.ndarray) or value.dtype.kind in 'fiub'
+    return isinstance(value, np.generic)
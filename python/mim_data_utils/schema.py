@@ -0,0 +1,187 @@
+"""
+Schema-interned samples.
+
+A producer logging the same fields over and over announces their layout once,
+as a schema: a setup item of kind 'schema' whose payload is
+
+    {'id': id, 'fields': [[name, dtype, dim], ...]}
+
+`dtype` is a numpy dtype string ('<f8', '<f4', '|b1', ...) and `dim` is 0 for
+a scalar and the vector length otherwise. The id is derived from the fields,
+so the same layout gets the same id in every producer. Samples matching it
+then travel as
+
+    {'type': 'packed_samples', 'session': ..., 'schema': id,
+     'rows': [[time, values], ...]}
+
+where `values` holds the little-endian values of all fields back to back,
+the scalars first and then the vectors, each in the schema's order, instead
+of a dict repeating every field name per sample. The server keeps schemas
+with the other setups and replays them to late viewers; readers expand the
+rows back into 'sample' items.
+"""
+
+import struct
+import time
+import zlib
+
+import numpy as np
+import ormsgpack
+
+_SCALAR_DTYPES = {float: '<f8', int: '<i8', bool: '|b1'}
+_STRUCT_CODES = {'<f8': 'd', '<i8': 'q', '|b1': '?'}
+# Array dtypes (without byte order) packed into rows, those the viewer
+# decodes (js/data_sources.js). Others, e.g. float16, stay plain samples.
+_ARRAY_DTYPES = {'f8', 'f4', 'i8', 'i4', 'i2', 'i1', 'u8', 'u4', 'u2', 'u1',
+                 'b1'}
+
+
+def field_spec(value):
+    """`(dtype, dim)` of a payload value, None if it can't be packed."""
+    dtype = _SCALAR_DTYPES.get(type(value))
+    if dtype is not None:
+        return dtype, 0
+    if isinstance(value, np.ndarray) and value.ndim == 1 and len(value) and \
+            value.dtype.str[1:] in _ARRAY_DTYPES:
+        return value.dtype.str, len(value)
+    return None
+
+
+def schema_id(fields):
+    """The id of a field layout (a 31 bit hash of it)."""
+    return zlib.crc32(ormsgpack.packb(fields)) & 0x7FFFFFFF
+
+
+class SampleSchema:
+    """A field layout with its packed value format."""
+
+    def __init__(self, fields, id=None):
+        self.fields = [list(field) for field in fields]
+        self.id = schema_id(self.fields) if id is None else id
+
+        # Scalars are packed before vectors, in one struct call.
+        self.scalars = [name for name, _, dim in self.fields if not dim]
+        self.vectors = [name for name, _, dim in self.fields if dim]
+        self._struct = struct.Struct('<' + ''.join(
+            _STRUCT_CODES[dtype] for _, dtype, dim in self.fields if not dim))
+        packed = [field for field in self.fields if not field[2]] + \
+            [field for field in self.fields if field[2]]
+        self.dtype = np.dtype([
+            (name, dtype, (dim,)) if dim else (name, dtype)
+            for name, dtype, dim in packed])
+
+    @classmethod
+    def from_payload(cls, payload):
+        """The schema of a sample payload, None if some value can't be
+        packed."""
+        fields = []
+        for name, value in payload.items():
+            spec = field_spec(value)
+            if spec is None:
+                return None
+            fields.append([name, *spec])
+        return cls(fields)
+
+    def to_payload(self):
+        return {'id': self.id, 'fields': self.fields}
+
+    def pack(self, payload):
+        """The packed values of a payload matching the schema."""
+        parts = [self._struct.pack(*[payload[name] for name in self.scalars])]
+        parts.extend(payload[name].tobytes() for name in self.vectors)
+        return b''.join(parts)
+
+    def columns(self, rows):
+        """`(time, {name: column})` of packed rows, in the schema's order,
+        scalars as [N] and vectors as [N, dim] arrays."""
+        time = np.array([row[0] for row in rows], np.float64)
+        values = np.frombuffer(b''.join(row[1] for row in rows), self.dtype)
+        return time, {name: values[name] for name, _, _ in self.fields}
+
+    def expand(self, item):
+        """The 'sample' items of a 'packed_samples' item."""
+        time, columns = self.columns(item['rows'])
+        session = item.get('session')
+        names = list(columns)
+        values = [columns[name].tolist() for name in names]
+        return [
+            {'type': 'sample', 'time': t, 'session': session,
+             'payload': dict(zip(names, row))}
+            for t, row in zip(time.tolist(), zip(*values))
+        ]
+
+
+class SchemaInterner:
+    """Turns the 'sample' items of outgoing batches into 'packed_samples'.
+
+    New layouts are announced by a schema setup item placed before the first
+    packed samples using them. Every schema in use is announced again after
+    `refresh_s` seconds, so a server that lost it (e.g. after evicting the
+    session) picks it up again. `make_setup(payload)` builds the setup item.
+    """
+
+    def __init__(self, make_setup, refresh_s=5.):
+        self.make_setup = make_setup
+        self.refresh_s = refresh_s
+        self._schemas = {}    # layout -> SampleSchema
+        self._announced = {}  # schema id -> time announced
+
+    def _schema(self, payload):
+        # A cheap key for the layout; `field_spec` only runs for new ones.
+        layout = tuple(
+            (name, value.dtype, value.shape) if type(value) is np.ndarray
+            else (name, type(value))
+            for name, value in payload.items())
+        try:
+            return self._schemas[layout]
+        except KeyError:
+            # None for payloads that can't be packed (e.g. strings).
+            schema = self._schemas[layout] = SampleSchema.from_payload(payload)
+            return schema
+
+    def intern(self, items):
+        now = time.monotonic()
+        res = []
+        packed = {}  # (session, schema id) -> packed_samples item
+
+        for item in items:
+            t = item.get('time')
+            if item.get('type') != 'sample' or \
+                    not isinstance(t, (float, int)) or isinstance(t, bool):
+                res.append(item)
+                continue
+
+            schema = self._schema(item['payload'])
+            if schema is None:
+                res.append(item)
+                continue
+
+            try:
+                values = schema.pack(item['payload'])
+            except (struct.error, OverflowError):
+                res.append(item)
+                continue
+
+            if now - self._announced.get(schema.id, -self.refresh_s) >= \
+                    self.refresh_s:
+                self._announced[schema.id] = now
+                res.append(self.make_setup(schema.to_payload()))
+
+            session = item.get('session')
+            group = packed.get((session, schema.id))
+            if group is None:
+                group = packed[(session, schema.id)] = {
+                    'type': 'packed_samples',
+                    'session': session,
+                    'schema': schema.id,
+                    'rows': [],
+                }
+                res.append(group)
+            group['rows'].append([float(t), values])
+
+        return res
+
+
+def is_schema_setup(item):
+    return item.get('type') == 'setup' and item.get('kind') == 'schema' and \
+        item.get('op') == 'set'
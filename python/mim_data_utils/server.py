@@ -75,18 +75,23 @@ class SetupRegistry:
     live until explicitly removed or until the session is cleared: a producer
     disconnecting does not unload its scene, just as the timeseries and images
     it already sent stay in the viewer.
+
+    Sample schemas (kind 'schema', see `schema.py`) are needed to decode the
+    producers' packed samples rather than to render anything, so clearing the
+    session's setups or relaunching it keeps them; only eviction drops them.
     """
 
     def __init__(self):
-        # session -> {'setting': {key: item}, 'scene': {key: item}}. Settings
-        # are replayed before scene objects (they create the viewers/layout the
-        # objects go into) and insertion order is kept within each kind.
+        # session -> {'setting': {key: item}, 'schema': {key: item},
+        # 'scene': {key: item}}. Settings are replayed before scene objects
+        # (they create the viewers/layout the objects go into) and insertion
+        # order is kept within each kind.
         self.sessions = {}
         self._lock = threading.Lock()
 
     def _kinds(self, session):
         return self.sessions.setdefault(
-            session, {'setting': {}, 'scene': {}})
+            session, {'setting': {}, 'schema': {}, 'scene': {}})
 
     def apply(self, item):
         """Fold one setup item into the registry.
@@ -99,7 +104,7 @@ class SetupRegistry:
 
         with self._lock:
             if op == 'clear':
-                self.sessions.pop(session, None)
+                self._clear(session, keep_schemas=True)
                 return [item]
 
             kinds = self._kinds(session)
@@ -124,10 +129,15 @@ class SetupRegistry:
             print(f"[setup] ignoring unknown op: {op}")
             return []
 
-    def clear_session(self, session):
+    def _clear(self, session, keep_schemas):
+        kinds = self.sessions.pop(session, None)
+        if keep_schemas and kinds and kinds['schema']:
+            self._kinds(session)['schema'].update(kinds['schema'])
+
+    def clear_session(self, session, keep_schemas=False):
         """Drop all cached setups of `session` (launch restart / eviction)."""
         with self._lock:
-            self.sessions.pop(session, None)
+            self._clear(session, keep_schemas)
 
     def snapshot(self, session):
         """All setups of `session`, packed and ready to send to a new viewer."""
@@ -144,7 +154,9 @@ class SetupRegistry:
             if not kinds:
                 return []
 
-            return list(kinds['setting'].values()) + list(kinds['scene'].values())
+            return (list(kinds['setting'].values()) +
+                    list(kinds['schema'].values()) +
+                    list(kinds['scene'].values()))
 
 
 class WebsocketHandler(WebSocket):
@@ -419,7 +431,7 @@ def run():
                 # cached setups, and forward the launch so viewers clear the
                 # session's data and switch to it.
                 name = item.get('session') or 'Default'
-                setup_registry.clear_session(name)
+                setup_registry.clear_session(name, keep_schemas=True)
                 session_tracker.touch(name)
                 print(f"[session] launched: {name}")
                 changed.append(item)
@@ -73,7 +73,13 @@ setup(
     description="Utils for robot data handling and plotting",
     license="BSD-3-clause",
     entry_points={
-        "console_scripts": [],
+        "console_scripts": [
+            "mim-merge = mim_data_utils.merge:main",
+            "mim-overview = mim_data_utils.overview:main",
+            "mim-inspect = mim_data_utils.inspect_recording:main",
+            "mim-compact = mim_data_utils.compact:main",
+            "mim-convert-legacy = mim_data_utils.convert_legacy:main",
+        ],
     },
     python_requires=">=3.6",
     data_files=[